@@ -1,7 +1,8 @@
-import cgi
+import html
 import re
 import sys
 import os
+from array import array
 
 KEYWORDS = {
     'class',
@@ -46,123 +47,132 @@ TOKEN_TYPES = (
     INT_CONST,
     STRING_CONST
 )
-
-
-REGEX_MAPPING = {
-    KEYWORD: '(' + r'|'.join(KEYWORDS) + ')\\W',
-    SYMBOL: r'([&)\]+\*\-,\/<.}([{;~=|>])',
-    INT_CONST: r'(\d+)',
-    STRING_CONST: r'(".*?")',
-    IDENTIFIER: r'([a-zA-Z_]+[a-zA-Z_\d]*)'
+TOKEN_TYPE_CODES = {
+    token_type: code for code, token_type in enumerate(TOKEN_TYPES)
 }
 
+OUTPUT_BUFFER_SIZE = 1 << 16
 
-def remove_comments(line):
-    start_from = 0
-    while start_from != -1:
-        comment = line.find('//', start_from)
-        if comment == -1:
-            return line
-        # terminate if there is an even
-        # number of quotes before comment
-        if line[:comment].count('"') % 2 == 0:
-            start_from = -1
-        else:
-            start_from = comment + 1
 
-    return line[:comment].rstrip()
+TOKEN_REGEX = re.compile(
+    r'''
+    (?P<skip>\s+|//[^\n]*|/\*.*?\*/)
+    |(?P<word>[a-zA-Z_][a-zA-Z_\d]*)
+    |(?P<%s>\d+)
+    |"(?P<%s>[^"\n]*)"
+    |(?P<%s>[&)\]+\*\-,\/<.}([{;~=|>])
+    ''' % (INT_CONST, STRING_CONST, SYMBOL),
+    re.VERBOSE | re.DOTALL
+)
 
 
 class JackTokenizer(object):
-    cleaned_input = None
-
+    """
+    Tokenizes the whole input up front into a compact buffer of
+    parallel arrays: type codes, interned lexemes and line/column
+    """
     def __init__(self, f):
-        # read whole input into a stream
-        input_stream = ''.join(
-            remove_comments(line)
-            for line in f
-        ).replace('\n', '').replace('\r', '')
-        # get rid of the block comments
-        regex = r'(\/\*.*?\*\/)'
-        input_stream += '/**/'
-        spans = [m.span() for m in re.finditer(regex, input_stream)]
-        cleaned_input = ''
-        last_hi = 0
-        for lo, hi in spans:
-            cleaned_input += input_stream[last_hi:lo]
-            last_hi = hi
-
-        self.cleaned_input = cleaned_input.lstrip()
-
-    def match_and_extract(self, token_type, advance=True):
-        regex = REGEX_MAPPING[token_type]
-        match = re.match(
-            regex,
-            self.cleaned_input
-        )
-        if match:
-            word = match.groups()[0]
-            token = cgi.escape(word).strip('"')
-            if advance:
-                self.cleaned_input = self.cleaned_input.replace(
-                    word, '', 1
-                ).lstrip()
-            return (token, token_type)
-
-    def _next(self, advance=True):
-        for token_type in TOKEN_TYPES:
-            match = self.match_and_extract(token_type, advance)
-            if match:
-                return match
-        raise RuntimeError
+        self.token_types = array('B')
+        self.tokens = []
+        self.lines = array('L')
+        self.columns = array('L')
+        self.index = 0
+        self._tokenize(f.read())
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def _tokenize(self, input_stream):
+        match_token = TOKEN_REGEX.match
+        append_type = self.token_types.append
+        append_token = self.tokens.append
+        append_line = self.lines.append
+        append_column = self.columns.append
+        line = 1
+        line_start = 0
+        position = 0
+        end = len(input_stream)
+        while position < end:
+            match = match_token(input_stream, position)
+            if match is None:
+                raise RuntimeError(
+                    'line %d, column %d: unexpected character %r' % (
+                        line, position - line_start + 1, input_stream[position]
+                    )
+                )
+            token_type = match.lastgroup
+            if token_type == 'skip':
+                newlines = input_stream.count('\n', position, match.end())
+                if newlines:
+                    line += newlines
+                    line_start = input_stream.rfind(
+                        '\n', position, match.end()
+                    ) + 1
+            else:
+                token = html.escape(match.group(token_type), quote=False)
+                if token_type == 'word':
+                    token_type = KEYWORD if token in KEYWORDS else IDENTIFIER
+                append_type(TOKEN_TYPE_CODES[token_type])
+                append_token(sys.intern(token))
+                append_line(line)
+                append_column(position - line_start + 1)
+            position = match.end()
 
     def next(self):
-        if not self.cleaned_input:
+        index = self.index
+        if index >= len(self.tokens):
             raise StopIteration
 
-        return self._next()
+        self.index = index + 1
+        return (self.tokens[index], TOKEN_TYPES[self.token_types[index]])
+
+    __next__ = next
 
     def peek_next(self):
-        return self._next(advance=False)
+        index = self.index
+        if index >= len(self.tokens):
+            return (None, None)
+        return (self.tokens[index], TOKEN_TYPES[self.token_types[index]])
+
+    def location(self):
+        """
+        Line and column of the token most recently returned by next()
+        """
+        index = self.index - 1
+        return (self.lines[index], self.columns[index])
 
 
 class ParseTree(object):
     """
-    Class to store write-only Parse tree as an XML-formatted string
+    Class to stream write-only Parse tree as XML into a file-like object
     """
     TAB_SIZE = 2
-    representation = None
-    level = 0
 
-    def __init__(self):
-        self.representation = ''
+    def __init__(self, out):
+        self.write = out.write
         self.level = 0
+        # indentation strings are built once per nesting level
+        self.indents = ['']
 
     def append_tag_with_text(self, tag, text):
-        self.representation += self.indentation
-        self.representation += '<%s> %s </%s>\n' % (tag, text, tag)
+        self.write('%s<%s> %s </%s>\n' % (
+            self.indents[self.level], tag, text, tag
+        ))
 
     def open_tag(self, tag):
-        self.representation += self.indentation
-        self.representation += '<%s>\n' % tag
+        self.write('%s<%s>\n' % (self.indents[self.level], tag))
         self.level += 1
+        if self.level == len(self.indents):
+            self.indents.append(self.indents[-1] + ' ' * self.TAB_SIZE)
 
     def close_tag(self, tag):
         self.level -= 1
-        self.representation += self.indentation
-        self.representation += '</%s>\n' % tag
-
-    @property
-    def indentation(self):
         assert self.level >= 0
-        return (self.level * self.TAB_SIZE) * ' '
-
-    def __str__(self):
-        return self.representation
+        self.write('%s</%s>\n' % (self.indents[self.level], tag))
 
-    def __repr__(self):
-        return self.representation
-    
 
 class CompilationEngine(object):
     tokenizer = None
@@ -171,10 +181,10 @@ class CompilationEngine(object):
     token_type = None
     parse_tree = None
 
-    def __init__(self, f):
+    def __init__(self, f, xml_out):
         self.tokenizer = JackTokenizer(f)
         self.token, self.token_type = next(self.tokenizer)
-        self.parse_tree = ParseTree()
+        self.parse_tree = ParseTree(xml_out)
         # assign tree methods to current class
         # to avoid self.parse_tree boilerplate
         self.append_tag_with_text = self.parse_tree.append_tag_with_text
@@ -461,17 +471,17 @@ class CompilationEngine(object):
         self.open_tag('expression')
 
         self.compile_term()
-        operators = map(cgi.escape, (
+        operators = (
             '+',
             '-',
             '*',
             '/',
-            '&',
+            '&amp;',
             '|',
-            '<',
-            '>',
+            '&lt;',
+            '&gt;',
             '='
-        ))
+        )
         while self.token in operators:
             self.eat_and_append_token(
                 SYMBOL,
@@ -534,7 +544,11 @@ class CompilationEngine(object):
                 SYMBOL, ')'
             )
         else:
-            raise NotImplementedError
+            raise NotImplementedError(
+                'line %d, column %d: unexpected term %s' % (
+                    self.tokenizer.location() + (self.token,)
+                )
+            )
         self.close_tag('term')
 
     def compile_expression_list(self):
@@ -551,14 +565,16 @@ class CompilationEngine(object):
     def eat(self, token_type, token):
         if self.token != token:
             raise RuntimeError(
-                'Unexpected token '
-                'self.token: %s, argument token: %s' % (self.token, token)
+                'line %d, column %d: Unexpected token '
+                'self.token: %s, argument token: %s' % (
+                    self.tokenizer.location() + (self.token, token)
+                )
             )
         if self.token_type != token_type:
             raise RuntimeError(
-                'Unexpected token_type '
+                'line %d, column %d: Unexpected token_type '
                 'self.token_type: %s, argument token_type: %s' % (
-                    self.token_type, token_type
+                    self.tokenizer.location() + (self.token_type, token_type)
                 )
             )
         try:
@@ -567,23 +583,25 @@ class CompilationEngine(object):
             self.token = self.token_type = None
 
 
-file_list = []
-path = sys.argv[1]
-is_dir = os.path.isdir(path)
-if not is_dir:
-    file_list.append(path)
-else:
-    if not path.endswith('/'):
-        path = path + '/'
-    for filename in os.listdir(path):
-        if filename.endswith('.jack'):
-            path_to_file = os.path.join(path, filename)
-            file_list.append(path_to_file)
-
-
-for filename in file_list:
-    with open(filename.replace('.jack', '.xml'), 'w') as f:
-        current_file = open(filename)
-        compiled = CompilationEngine(current_file)
-        f.write(str(compiled.parse_tree))
-        current_file.close()
+def get_file_list(path):
+    file_list = []
+    if not os.path.isdir(path):
+        file_list.append(path)
+    else:
+        for filename in os.listdir(path):
+            if filename.endswith('.jack'):
+                path_to_file = os.path.join(path, filename)
+                file_list.append(path_to_file)
+    return file_list
+
+
+def main(path):
+    for filename in get_file_list(path):
+        xml_filename = filename.replace('.jack', '.xml')
+        with open(xml_filename, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
+            with open(filename) as current_file:
+                CompilationEngine(current_file, f)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -1,6 +1,14 @@
+import argparse
+import contextlib
+import hashlib
+import json
 import re
 import sys
 import os
+import struct
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 KEYWORDS = {
     'class',
@@ -45,6 +53,9 @@ TOKEN_TYPES = (
     INT_CONST,
     STRING_CONST
 )
+TOKEN_TYPE_CODES = {
+    token_type: code for code, token_type in enumerate(TOKEN_TYPES)
+}
 
 SUBROUTINE = 'subroutine'
 STATIC = 'static'
@@ -55,121 +66,173 @@ VAR = 'local'
 USED = 'used'
 DEFINED = 'defined'
 
-
-REGEX_MAPPING = {
-    KEYWORD: '(' + r'|'.join(KEYWORDS) + ')\\W',
-    SYMBOL: r'([&)\]+\*\-,\/<.}([{;~=|>])',
-    INT_CONST: r'(\d+)',
-    STRING_CONST: r'(".*?")',
-    IDENTIFIER: r'([a-zA-Z_]+[a-zA-Z_\d]*)'
-}
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+# symbols and string constants that need escaping in the .xml output
+XML_ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;'
+})
+
+# binary VM files (.vmb), all numbers little-endian: magic, u16 string
+# count, each string as a u16 length and ASCII bytes, then 5-byte records
+# up to the end of the file: u8 opcode, u16 segment (the count for
+# function and call) and u16 operand (a string table index for label
+# and function names), read back by VMTranslator.read_bytecode in
+# project 8
+BYTECODE_MAGIC = b'VMB\x02'
+BYTECODE_RECORD = struct.Struct('<BHH')
+BYTECODE_STRING_LENGTH = struct.Struct('<H')
+# largest count or string length a u16 field holds
+BYTECODE_LIMIT = 0xffff
+BYTECODE_OPCODES = dict((command, opcode) for opcode, command in enumerate((
+    'push', 'pop', 'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not',
+    'label', 'goto', 'if-goto', 'function', 'call', 'return'
+)))
+BYTECODE_SEGMENTS = dict((segment, code) for code, segment in enumerate((
+    'constant', 'argument', 'local', 'static', 'this', 'that', 'pointer',
+    'temp'
+)))
+
+
+TOKEN_REGEX = re.compile(
+    r'''
+    (?P<skip>\s+|//[^\n]*|/\*.*?\*/)
+    |(?P<word>[a-zA-Z_][a-zA-Z_\d]*)
+    |(?P<%s>\d+)
+    |"(?P<%s>[^"\n]*)"
+    |(?P<%s>[&)\]+\*\-,\/<.}([{;~=|>])
+    ''' % (INT_CONST, STRING_CONST, SYMBOL),
+    re.VERBOSE | re.DOTALL
+)
 
 
 class JackTokenizer(object):
-    cleaned_input = None
-
+    """
+    Tokenizes the whole input up front into a compact buffer of
+    parallel arrays: type codes, interned lexemes and line/column
+    """
     def __init__(self, f):
-        # read whole input into a stream
-        input_stream = ''.join(
-            self._remove_comments(line)
-            for line in f
-        ).replace('\n', '').replace('\r', '')
-        # get rid of the block comments
-        regex = r'(\/\*.*?\*\/)'
-        input_stream += '/**/'
-        spans = [m.span() for m in re.finditer(regex, input_stream)]
-        cleaned_input = ''
-        last_hi = 0
-        for lo, hi in spans:
-            cleaned_input += input_stream[last_hi:lo]
-            last_hi = hi
-
-        self.cleaned_input = cleaned_input.lstrip()
+        self.token_types = array('B')
+        self.tokens = []
+        self.lines = array('L')
+        self.columns = array('L')
+        self.index = 0
+        self._tokenize(f.read())
 
     def __iter__(self):
         return self
 
-    def _remove_comments(self, line):
-        start_from = 0
-        while start_from != -1:
-            comment = line.find('//', start_from)
-            if comment == -1:
-                return line
-            # terminate if there is an even
-            # number of quotes before comment
-            if line[:comment].count('"') % 2 == 0:
-                start_from = -1
+    def __len__(self):
+        return len(self.tokens)
+
+    def _tokenize(self, input_stream):
+        match_token = TOKEN_REGEX.match
+        append_type = self.token_types.append
+        append_token = self.tokens.append
+        append_line = self.lines.append
+        append_column = self.columns.append
+        line = 1
+        line_start = 0
+        position = 0
+        end = len(input_stream)
+        while position < end:
+            match = match_token(input_stream, position)
+            if match is None:
+                raise RuntimeError(
+                    'line %d, column %d: unexpected character %r' % (
+                        line, position - line_start + 1, input_stream[position]
+                    )
+                )
+            token_type = match.lastgroup
+            if token_type == 'skip':
+                newlines = input_stream.count('\n', position, match.end())
+                if newlines:
+                    line += newlines
+                    line_start = input_stream.rfind(
+                        '\n', position, match.end()
+                    ) + 1
             else:
-                start_from = comment + 1
-
-        return line[:comment].rstrip()
-
-    def match_and_extract(self, token_type, advance=True):
-        regex = REGEX_MAPPING[token_type]
-        match = re.match(
-            regex,
-            self.cleaned_input
-        )
-        if match:
-            word = match.groups()[0]
-            token = word.strip('"')
-            if advance:
-                self.cleaned_input = self.cleaned_input.replace(
-                    word, '', 1
-                ).lstrip()
-            return (token, token_type)
-
-    def _next(self, advance=True):
-        for token_type in TOKEN_TYPES:
-            match = self.match_and_extract(token_type, advance)
-            if match:
-                return match
-        raise RuntimeError
+                token = match.group(token_type)
+                if token_type == 'word':
+                    token_type = KEYWORD if token in KEYWORDS else IDENTIFIER
+                append_type(TOKEN_TYPE_CODES[token_type])
+                append_token(sys.intern(token))
+                append_line(line)
+                append_column(position - line_start + 1)
+            position = match.end()
 
     def next(self):
-        if not self.cleaned_input:
+        index = self.index
+        if index >= len(self.tokens):
             raise StopIteration
 
-        return self._next()
+        self.index = index + 1
+        return (self.tokens[index], TOKEN_TYPES[self.token_types[index]])
+
+    __next__ = next
 
     def peek_next(self):
-        return self._next(advance=False)
+        index = self.index
+        if index >= len(self.tokens):
+            return (None, None)
+        return (self.tokens[index], TOKEN_TYPES[self.token_types[index]])
+
+    def location(self):
+        """
+        Line and column of the token most recently returned by next()
+        """
+        index = self.index - 1
+        return (self.lines[index], self.columns[index])
 
 
 class ParseTree(object):
     """
-    Class to store write-only Parse tree as an XML-formatted string
+    Class to stream write-only Parse tree as XML into a file-like object
     """
     TAB_SIZE = 2
+    enabled = True
 
-    def __init__(self):
-        self.representation = ''
+    def __init__(self, out):
+        self.write = out.write
         self.level = 0
+        # indentation strings are built once per nesting level
+        self.indents = ['']
 
     def append_tag_with_text(self, tag, text):
-        self.representation += self.indentation
-        self.representation += '<%s> %s </%s>\n' % (tag, text, tag)
+        self.write('%s<%s> %s </%s>\n' % (
+            self.indents[self.level], tag, str(text).translate(XML_ESCAPES),
+            tag
+        ))
 
     def open_tag(self, tag):
-        self.representation += self.indentation
-        self.representation += '<%s>\n' % tag
+        self.write('%s<%s>\n' % (self.indents[self.level], tag))
         self.level += 1
+        if self.level == len(self.indents):
+            self.indents.append(self.indents[-1] + ' ' * self.TAB_SIZE)
 
     def close_tag(self, tag):
         self.level -= 1
-        self.representation += self.indentation
-        self.representation += '</%s>\n' % tag
-
-    @property
-    def indentation(self):
         assert self.level >= 0
-        return (self.level * self.TAB_SIZE) * ' '
+        self.write('%s</%s>\n' % (self.indents[self.level], tag))
 
-    def __str__(self):
-        return self.representation
 
-    def __repr__(self):
-        return self.representation
+class NullParseTree(object):
+    """
+    Stand-in for ParseTree when no XML output is requested
+    """
+    enabled = False
+
+    def append_tag_with_text(self, tag, text):
+        pass
+
+    def open_tag(self, tag):
+        pass
+
+    def close_tag(self, tag):
+        pass
 
 
 class SymbolTable(object):
@@ -222,45 +285,160 @@ class SymbolTable(object):
             return None
 
 
-class VMWriter(object):
+class VMSink(object):
+    """
+    Destination for VMWriter commands, hands each of them to emit and
+    counts what passes through
+    """
+    def __init__(self, emit):
+        self.emit = emit
+        self.commands_written = 0
+        self.bytes_written = 0
+
+    def write(self, command):
+        self.commands_written += 1
+        self.bytes_written += len(command)
+        self.emit(command)
+
+
+class FileSink(VMSink):
+    """
+    Streams commands into a (buffered) file-like object
+    """
+    def __init__(self, f):
+        super(FileSink, self).__init__(f.write)
+
+
+class ListSink(VMSink):
+    """
+    Keeps commands in memory
+    """
+    def __init__(self):
+        self.commands = []
+        super(ListSink, self).__init__(self.commands.append)
+
+    def getvalue(self):
+        return ''.join(self.commands)
+
+
+class BufferSink(VMSink):
+    """
+    Collects encoded commands in a bytearray
+    """
     def __init__(self):
-        self.representation = ''
+        self.buffer = bytearray()
+        super(BufferSink, self).__init__(self.buffer.extend)
+
+
+class VMWriter(object):
+    def __init__(self, sink):
+        self.sink = sink
+        self.write = sink.write
 
     def write_push(self, segment, index):
-        self.representation += 'push %s %d\n' % (segment.lower(), int(index))
+        self.write('push %s %d\n' % (segment.lower(), int(index)))
 
     def write_pop(self, segment, index):
-        self.representation += 'pop %s %d\n' % (segment.lower(), int(index))
+        self.write('pop %s %d\n' % (segment.lower(), int(index)))
 
     def write_arithmetic(self, command):
-        self.representation += command.lower() + '\n'
+        self.write(command.lower() + '\n')
 
     def write_label(self, s):
-        self.representation += 'label %s\n' % s
+        self.write('label %s\n' % s)
 
     def write_goto(self, s):
-        self.representation += 'goto %s\n' % s
+        self.write('goto %s\n' % s)
 
     def write_if(self, s):
-        self.representation += 'if-goto %s\n' % s
+        self.write('if-goto %s\n' % s)
 
     def write_call(self, name, arg_count):
-        self.representation += 'call %s %d\n' % (name, arg_count)
+        self.write('call %s %d\n' % (name, arg_count))
 
     def write_function(self, name, local_count):
-        self.representation += 'function %s %d\n' % (name, local_count)
+        self.write('function %s %d\n' % (name, local_count))
 
     def write_return(self):
-        self.representation += 'return\n'
+        self.write('return\n')
+
+
+class BytecodeWriter(VMWriter):
+    """
+    VMWriter emitting .vmb records, names go into a string table that
+    header() puts in front of the records once the class is compiled
+    """
+    def __init__(self, sink):
+        super(BytecodeWriter, self).__init__(sink)
+        self.strings = {}
+
+    def record(self, command, segment=0, operand=0):
+        if segment > BYTECODE_LIMIT:
+            raise ValueError('%s count %d does not fit in a .vmb record' % (
+                command, segment
+            ))
+        self.write(BYTECODE_RECORD.pack(
+            BYTECODE_OPCODES[command], segment, operand
+        ))
+
+    def intern(self, name):
+        return self.strings.setdefault(name, len(self.strings))
+
+    def header(self):
+        parts = [BYTECODE_MAGIC, struct.pack('<H', len(self.strings))]
+        for name in self.strings:
+            encoded = name.encode('ascii')
+            if len(encoded) > BYTECODE_LIMIT:
+                raise ValueError('name %s... is too long for a .vmb file' % (
+                    name[:32]
+                ))
+            parts.append(BYTECODE_STRING_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        return b''.join(parts)
+
+    def write_push(self, segment, index):
+        self.record('push', BYTECODE_SEGMENTS[segment.lower()], int(index))
+
+    def write_pop(self, segment, index):
+        self.record('pop', BYTECODE_SEGMENTS[segment.lower()], int(index))
+
+    def write_arithmetic(self, command):
+        self.record(command.lower())
+
+    def write_label(self, s):
+        self.record('label', 0, self.intern(s))
+
+    def write_goto(self, s):
+        self.record('goto', 0, self.intern(s))
+
+    def write_if(self, s):
+        self.record('if-goto', 0, self.intern(s))
+
+    def write_call(self, name, arg_count):
+        self.record('call', arg_count, self.intern(name))
+
+    def write_function(self, name, local_count):
+        self.record('function', local_count, self.intern(name))
+
+    def write_return(self):
+        self.record('return')
 
 
 class CompilationEngine(object):
-    def __init__(self, f):
+    def __init__(self, f, sink=None, xml_out=None, bytecode=False):
         self.tokenizer = JackTokenizer(f)
         self.token, self.token_type = next(self.tokenizer)
-        self.parse_tree = ParseTree()
+        if xml_out is not None:
+            self.parse_tree = ParseTree(xml_out)
+        else:
+            self.parse_tree = NullParseTree()
         self.symbol_table = SymbolTable()
-        self.vm_writer = VMWriter()
+        if sink is None:
+            sink = BufferSink() if bytecode else ListSink()
+        if bytecode:
+            self.vm_writer = BytecodeWriter(sink)
+        else:
+            self.vm_writer = VMWriter(sink)
         self.class_name = None
         self.while_index = 0
         self.if_index = 0
@@ -285,14 +463,16 @@ class CompilationEngine(object):
     def eat(self, token_type, token):
         if self.token != token:
             raise RuntimeError(
-                'Unexpected token '
-                'self.token: %s, argument token: %s' % (self.token, token)
+                'line %d, column %d: Unexpected token '
+                'self.token: %s, argument token: %s' % (
+                    self.tokenizer.location() + (self.token, token)
+                )
             )
         if self.token_type != token_type:
             raise RuntimeError(
-                'Unexpected token_type '
+                'line %d, column %d: Unexpected token_type '
                 'self.token_type: %s, argument token_type: %s' % (
-                    self.token_type, token_type
+                    self.tokenizer.location() + (self.token_type, token_type)
                 )
             )
         self.previous_token = self.token
@@ -303,6 +483,8 @@ class CompilationEngine(object):
 
     def eat_and_append_token(self, token_type, token, category=None, action=None):
         self.eat(token_type, token)
+        if not self.parse_tree.enabled:
+            return
         if token_type == IDENTIFIER:
             token = self.get_identifier_info(token, category, action)
         self.append_tag_with_text(
@@ -892,7 +1074,11 @@ class CompilationEngine(object):
                 SYMBOL, ')'
             )
         else:
-            raise NotImplementedError
+            raise NotImplementedError(
+                'line %d, column %d: unexpected term %s' % (
+                    self.tokenizer.location() + (self.token,)
+                )
+            )
         self.close_tag('term')
 
     def compile_expression_list(self):
@@ -910,28 +1096,225 @@ class CompilationEngine(object):
         return arg_count
 
 
-file_list = []
-path = sys.argv[1]
-# print('<tokens>')
-# for token, token_type in JackTokenizer(open(path)):
-#     print('<%s> %s </%s>' % (token_type, token, token_type))
-# print('</tokens>')
-is_dir = os.path.isdir(path)
-if not is_dir:
-    file_list.append(path)
-else:
-    if not path.endswith('/'):
-        path = path + '/'
-    for filename in os.listdir(path):
-        if filename.endswith('.jack'):
-            path_to_file = os.path.join(path, filename)
-            file_list.append(path_to_file)
-
-
-for filename in file_list:
-    with open(filename.replace('.jack', '.vm'), 'w') as f:
-        current_file = open(filename)
-        compiled = CompilationEngine(current_file)
-        # print(compiled.vm_writer.representation)
-        f.write(str(compiled.vm_writer.representation))
-        current_file.close()
+class BuildCache(object):
+    """
+    On-disk record of the source hash each .vm file was compiled from,
+    so unchanged classes can be skipped on the next run
+    """
+    FILENAME = '.jackcache.json'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.FILENAME)
+        self.hits = 0
+        self.misses = 0
+        with open(os.path.abspath(__file__), 'rb') as f:
+            self.compiler_version = hashlib.sha256(f.read()).hexdigest()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def key(self, filename, xml=False, bytecode=False):
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return '%s:%s:%d:%d' % (self.compiler_version, digest, xml, bytecode)
+
+    def lookup(self, filename, key, xml=False, bytecode=False):
+        fresh = (
+            self.entries.get(os.path.basename(filename)) == key and
+            os.path.exists(get_output_path(filename, bytecode)) and (
+                not xml or os.path.exists(filename.replace('.jack', '.xml'))
+            )
+        )
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return fresh
+
+    def store(self, filename, key):
+        self.entries[os.path.basename(filename)] = key
+
+    def discard(self, filename):
+        # the output on disk no longer matches any recorded source
+        self.entries.pop(os.path.basename(filename), None)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def get_file_list(path):
+    file_list = []
+    if not os.path.isdir(path):
+        file_list.append(path)
+    else:
+        for filename in os.listdir(path):
+            if filename.endswith('.jack'):
+                path_to_file = os.path.join(path, filename)
+                file_list.append(path_to_file)
+    return file_list
+
+
+def get_output_path(filename, bytecode=False):
+    return filename.replace('.jack', '.vmb' if bytecode else '.vm')
+
+
+@contextlib.contextmanager
+def atomic_output(path, mode='w', buffering=-1):
+    """
+    File writing to a temporary file next to path, which replaces path
+    only once the block finishes without raising
+    """
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, mode, buffering=buffering)
+    try:
+        yield f
+    except BaseException:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    f.close()
+    os.replace(tmp_path, path)
+
+
+def compile_bytecode(filename, xml_out=None):
+    """
+    Compile into memory and write the .vmb header, string table and
+    records with a single write
+    """
+    sink = BufferSink()
+    with open(filename) as current_file:
+        engine = CompilationEngine(current_file, sink, xml_out, bytecode=True)
+    with atomic_output(get_output_path(filename, True), 'wb') as f:
+        f.write(engine.vm_writer.header() + sink.buffer)
+    return sink
+
+
+def compile_file(filename, xml=False, bytecode=False):
+    """
+    Compile a class, its .vm/.vmb and .xml appear only when the whole
+    class compiled, a failed compile leaves the previous files in place
+    """
+    with contextlib.ExitStack() as outputs:
+        xml_out = None
+        if xml:
+            xml_out = outputs.enter_context(atomic_output(
+                filename.replace('.jack', '.xml'),
+                buffering=OUTPUT_BUFFER_SIZE
+            ))
+        if bytecode:
+            return compile_bytecode(filename, xml_out)
+        with open(filename) as current_file, atomic_output(
+            get_output_path(filename), buffering=OUTPUT_BUFFER_SIZE
+        ) as f:
+            sink = FileSink(f)
+            CompilationEngine(current_file, sink, xml_out)
+        return sink
+
+
+def compile_job(job):
+    """
+    Compile one class, returning its stats or the error instead of raising
+    so that a failing worker does not take the whole pool down
+    """
+    filename, xml, bytecode = job
+    start = time.perf_counter()
+    try:
+        sink = compile_file(filename, xml, bytecode)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        return (filename, None, time.perf_counter() - start, error)
+    return (
+        filename,
+        (sink.commands_written, sink.bytes_written),
+        time.perf_counter() - start,
+        None
+    )
+
+
+def main(path, xml=False, stats=False, jobs=1, use_cache=True,
+         bytecode=False):
+    # print('<tokens>')
+    # for token, token_type in JackTokenizer(open(path)):
+    #     print('<%s> %s </%s>' % (token_type, token, token_type))
+    # print('</tokens>')
+    start = time.perf_counter()
+    file_list = sorted(get_file_list(path))
+    cache = None
+    keys = {}
+    if use_cache:
+        cache = BuildCache(
+            path if os.path.isdir(path) else os.path.dirname(path)
+        )
+        for filename in file_list:
+            keys[filename] = cache.key(filename, xml, bytecode)
+        file_list = [
+            filename for filename in file_list
+            if not cache.lookup(filename, keys[filename], xml, bytecode)
+        ]
+
+    job_list = [(filename, xml, bytecode) for filename in file_list]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(compile_job, job_list))
+    else:
+        results = [compile_job(job) for job in job_list]
+
+    failed = 0
+    for filename, counts, elapsed, error in results:
+        if error is not None:
+            failed += 1
+            sys.stderr.write('%s: %s\n' % (filename, error))
+            if cache is not None:
+                cache.discard(filename)
+            continue
+        if cache is not None:
+            cache.store(filename, keys[filename])
+        if stats:
+            print('%s: %d commands, %d bytes in %.3fs' % (
+                (filename,) + counts + (elapsed,)
+            ))
+    if cache is not None:
+        cache.save()
+    if stats:
+        print('%d files compiled, %d failed in %.3fs' % (
+            len(results) - failed, failed, time.perf_counter() - start
+        ))
+        if cache is not None:
+            print('cache: %d hits, %d misses' % (cache.hits, cache.misses))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='.jack file or directory of .jack files')
+    parser.add_argument(
+        '--xml', action='store_true',
+        help='also stream the parse tree of each class into a .xml file'
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print VM commands, bytes written and timings per file'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='number of worker processes compiling files in parallel'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='recompile every file, ignoring the incremental build cache'
+    )
+    parser.add_argument(
+        '--bytecode', action='store_true',
+        help='write binary .vmb files instead of textual .vm files'
+    )
+    args = parser.parse_args()
+    if main(
+        args.path, args.xml, args.stats, args.jobs, not args.no_cache,
+        args.bytecode
+    ):
+        sys.exit(1)
@@ -0,0 +1,43 @@
+import argparse
+import io
+import os
+import time
+
+from JackCompiler import JackTokenizer
+
+OS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'project_12'
+)
+
+
+def generate_input(size):
+    """
+    Concatenate the Jack OS sources until the input is at least `size` bytes
+    """
+    sources = []
+    for filename in sorted(os.listdir(OS_DIR)):
+        if filename.endswith('.jack'):
+            with open(os.path.join(OS_DIR, filename)) as f:
+                sources.append(f.read())
+    chunk = '\n'.join(sources)
+    return chunk * (size // len(chunk) + 1)
+
+
+def bench_tokenizer(size):
+    source = generate_input(size)
+    start = time.perf_counter()
+    token_count = sum(1 for _ in JackTokenizer(io.StringIO(source)))
+    elapsed = time.perf_counter() - start
+    print('tokenizer: %.1f MB, %d tokens in %.3fs, %d tokens/s' % (
+        len(source) / 1e6, token_count, elapsed, token_count / elapsed
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--size', type=float, default=4,
+        help='size of the generated input in megabytes'
+    )
+    args = parser.parse_args()
+    bench_tokenizer(int(args.size * 1e6))
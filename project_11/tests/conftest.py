@@ -0,0 +1,7 @@
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the compiler lives one level up
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
@@ -0,0 +1,29 @@
+import contextlib
+import io
+import os
+import shutil
+from xml.dom import minidom
+
+import JackCompiler
+
+OS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'project_12')
+
+
+def compile_os(tmp_path, **options):
+    """
+    Compile a copy of the Jack OS, returning its directory
+    """
+    shutil.copytree(OS_DIR, str(tmp_path / 'os'))
+    path = str(tmp_path / 'os')
+    with contextlib.redirect_stdout(io.StringIO()):
+        JackCompiler.main(path, use_cache=False, **options)
+    return path
+
+
+def test_xml_is_well_formed(tmp_path):
+    path = compile_os(tmp_path, xml=True)
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.jack'):
+            minidom.parse(os.path.join(path, filename[:-5] + '.xml'))
+    with open(os.path.join(path, 'Math.xml')) as f:
+        assert '<symbol> &lt; </symbol>' in f.read()
@@ -1,8 +1,22 @@
+import argparse
+import mmap
 import sys
+from array import array
 
 
-file = open(sys.argv[1])
+PREDEFINED_SYMBOLS = dict(
+    [('R%d' % i, i) for i in range(16)] + [
+        ('SP', 0),
+        ('LCL', 1),
+        ('ARG', 2),
+        ('THIS', 3),
+        ('THAT', 4),
+        ('SCREEN', 16384),
+        ('KBD', 24576)
+    ]
+)
 
+VARIABLE_BASE = 16
 
 DEST_LOOKUP = {
     None: '000',
@@ -26,19 +40,6 @@ JUMP_LOOKUP = {
     'JMP': '111'
 }
 
-A_VALUES = (
-    'M',
-    '!M',
-    '-M',
-    'M+1',
-    'M-1',
-    'D+M',
-    'D-M',
-    'M-D',
-    'D&M',
-    'D|M'
-)
-
 COMP_LOOKUP = {
     '0': '101010',
     '1': '111111',
@@ -57,30 +58,175 @@ COMP_LOOKUP = {
     'D-A': '010011',
     'A-D': '000111',
     'D&A': '000000',
-    'D|A': '010101'
+    'D|A': '010101',
+    # commutative operand orders
+    'A+D': '000010',
+    'A&D': '000000',
+    'A|D': '010101'
 }
 
 
 def remove_whitespace(line):
-    return line.replace(' ', '').split('//')[0].strip()
+    return line.partition('//')[0].replace(' ', '').strip()
 
 
 def parse_c_instruction(c_instruction):
+    dest = jump = None
     if '=' in c_instruction:
-        return c_instruction.split('=') + [None]
-    return [None] + c_instruction.split(';')
+        dest, c_instruction = c_instruction.split('=')
+    if ';' in c_instruction:
+        c_instruction, jump = c_instruction.split(';')
+    return [dest, c_instruction, jump or None]
+
+
+def build_c_instruction_table():
+    """
+    Map every `dest=comp;jump` spelling to its 16-bit word, the M forms
+    of a computation are its A forms with the a-bit set
+    """
+    table = {}
+    for comp, comp_bits in COMP_LOOKUP.items():
+        variants = [(comp, '0')]
+        if 'A' in comp:
+            variants.append((comp.replace('A', 'M'), '1'))
+        for comp_text, a in variants:
+            for dest, dest_bits in DEST_LOOKUP.items():
+                for jump, jump_bits in JUMP_LOOKUP.items():
+                    text = comp_text
+                    if dest:
+                        text = '%s=%s' % (dest, text)
+                    if jump:
+                        text = '%s;%s' % (text, jump)
+                    table[text] = int(
+                        '111' + a + comp_bits + dest_bits + jump_bits, 2
+                    )
+    return table
+
+
+C_INSTRUCTIONS = build_c_instruction_table()
+
+
+def a_instruction(value):
+    if value > 0x7fff:
+        raise ValueError('@%d does not fit in a 15-bit A-instruction' % value)
+    return value
 
 
-def translate(line):
-    if line.startswith('@'):
-        return f'{bin(int(line[1:]))[2:].zfill(16)}'
+def c_instruction(line):
+    if line in C_INSTRUCTIONS:
+        return C_INSTRUCTIONS[line]
+    # spellings such as `D=D-M;` with an empty jump field
     dest, comp, jump = parse_c_instruction(line)
-    a = 1 if comp in A_VALUES else 0
-    comp = comp.replace('M', 'A')
-    return f'111{a}{COMP_LOOKUP[comp]}{DEST_LOOKUP[dest]}{JUMP_LOOKUP[jump]}'
+    text = comp
+    if dest:
+        text = '%s=%s' % (dest, text)
+    if jump:
+        text = '%s;%s' % (text, jump)
+    if text not in C_INSTRUCTIONS:
+        raise ValueError('Unknown instruction %s' % line)
+    return C_INSTRUCTIONS[text]
+
+
+def assemble(lines, symbols=None):
+    """
+    Single scan over the source: labels are bound as they are met and
+    references to symbols not known yet are back-patched, whatever is
+    still unresolved at the end becomes a variable from RAM[16] on.
+    A `symbols` dict passed in is filled with the final symbol table.
+    """
+    if symbols is None:
+        symbols = {}
+    symbols.update(PREDEFINED_SYMBOLS)
+    # symbol -> indexes of the instructions waiting for its address
+    pending = {}
+    words = []
+    append = words.append
+    for line in lines:
+        parsed_line = remove_whitespace(line)
+        if not parsed_line:
+            continue
+        first = parsed_line[0]
+        if first == '@':
+            value = parsed_line[1:]
+            if value.isdigit():
+                append(a_instruction(int(value)))
+            elif value in symbols:
+                append(a_instruction(symbols[value]))
+            else:
+                pending.setdefault(value, []).append(len(words))
+                append(None)
+        elif first == '(':
+            label = parsed_line[1:-1]
+            address = len(words)
+            symbols[label] = address
+            for index in pending.pop(label, ()):
+                words[index] = a_instruction(address)
+        else:
+            append(c_instruction(parsed_line))
+
+    # pending keeps first-use order, which is the variable allocation order
+    for address, (symbol, indexes) in enumerate(
+        pending.items(), VARIABLE_BASE
+    ):
+        symbols[symbol] = address
+        for index in indexes:
+            words[index] = address
+    return words
+
+
+def write_hack(words, out):
+    """
+    Textual .hack output, each distinct word is formatted once and the
+    whole image goes out in a single write
+    """
+    lines = {word: '{:016b}\n'.format(word) for word in set(words)}
+    out.write(''.join(map(lines.__getitem__, words)))
+
+
+def write_bin(words, out):
+    """
+    Packed ROM image: one little-endian 16-bit word per instruction
+    """
+    rom = array('H', words)
+    if sys.byteorder == 'big':
+        rom.byteswap()
+    out.write(rom.tobytes())
+
+
+def load_bin(path):
+    """
+    Load a packed ROM image as a memoryview of 16-bit words, mapped
+    straight from the file without copying on little-endian hosts
+    """
+    with open(path, 'rb') as f:
+        if not f.seek(0, 2):
+            return memoryview(b'').cast('H')
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == 'big':
+        rom = array('H', mapped)
+        rom.byteswap()
+        mapped.close()
+        return memoryview(rom)
+    return memoryview(mapped).cast('H')
 
 
-for line in file:
-    parsed_line = remove_whitespace(line)
-    if parsed_line:
-        print(translate(parsed_line))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='.asm file to assemble')
+    parser.add_argument(
+        '--out', help='.hack file to write, standard output by default'
+    )
+    parser.add_argument(
+        '--bin', help='also write a packed little-endian ROM image here'
+    )
+    args = parser.parse_args()
+    with open(args.path) as file:
+        words = assemble(file)
+    if args.out:
+        with open(args.out, 'w') as out:
+            write_hack(words, out)
+    else:
+        write_hack(words, sys.stdout)
+    if args.bin:
+        with open(args.bin, 'wb') as out:
+            write_bin(words, out)
@@ -0,0 +1,198 @@
+import argparse
+import io
+import os
+import random
+import time
+
+import assembler
+import emulator
+
+# C-instructions as emitted by the VM translator
+C_INSTRUCTIONS = (
+    'D=A',
+    'D=M',
+    'A=M',
+    'M=D',
+    'M=M+1',
+    'AM=M-1',
+    'A=M-1',
+    'M=M+D',
+    'D=M-D',
+    'MD=M+1',
+    'M=-1',
+    'M=0',
+    'D;JEQ',
+    'D;JNE',
+    '0;JMP'
+)
+
+LEGACY_A_VALUES = (
+    'M', '!M', '-M', 'M+1', 'M-1', 'D+M', 'D-M', 'M-D', 'D&M', 'D|M',
+    'M+D', 'M&D', 'M|D'
+)
+
+
+def legacy_translate(line):
+    """
+    Per-line encoder the table-driven one replaced, kept for comparison
+    """
+    if line.startswith('@'):
+        return f'{bin(int(line[1:]))[2:].zfill(16)}'
+    dest, comp, jump = assembler.parse_c_instruction(line)
+    a = 1 if comp in LEGACY_A_VALUES else 0
+    comp = comp.replace('M', 'A')
+    return (
+        f'111{a}{assembler.COMP_LOOKUP[comp]}'
+        f'{assembler.DEST_LOOKUP[dest]}{assembler.JUMP_LOOKUP[jump]}'
+    )
+
+
+def legacy_assemble(lines, out):
+    symbols = dict(assembler.PREDEFINED_SYMBOLS)
+    pending = {}
+    binary = []
+    for line in lines:
+        parsed_line = assembler.remove_whitespace(line)
+        if not parsed_line:
+            continue
+        if parsed_line.startswith('('):
+            label = parsed_line[1:-1]
+            symbols[label] = len(binary)
+            for index in pending.pop(label, ()):
+                binary[index] = legacy_translate('@%d' % len(binary))
+        elif parsed_line.startswith('@') and not parsed_line[1:].isdigit():
+            symbol = parsed_line[1:]
+            if symbol in symbols:
+                binary.append(legacy_translate('@%d' % symbols[symbol]))
+            else:
+                pending.setdefault(symbol, []).append(len(binary))
+                binary.append(None)
+        else:
+            binary.append(legacy_translate(parsed_line))
+    for address, indexes in enumerate(pending.values(), 16):
+        for index in indexes:
+            binary[index] = legacy_translate('@%d' % address)
+    for line in binary:
+        print(line, file=out)
+
+
+def generate_input(line_count, seed=0):
+    """
+    Translator-shaped source: comments, labels within ROM range and
+    references to them, variables, constants and C-instructions
+    """
+    rng = random.Random(seed)
+    lines = []
+    labels = 0
+    while len(lines) < line_count:
+        kind = rng.random()
+        if kind < 0.05:
+            lines.append('// push constant %d' % rng.randrange(100))
+        elif kind < 0.07 and len(lines) < 30000:
+            lines.append('(LABEL_%d)' % labels)
+            labels += 1
+        elif kind < 0.10 and labels:
+            lines.append('@LABEL_%d' % rng.randrange(labels))
+        elif kind < 0.15:
+            lines.append('@Static.%d' % rng.randrange(200))
+        elif kind < 0.35:
+            lines.append('@%d' % rng.randrange(32768))
+        elif kind < 0.45:
+            lines.append('@SP')
+        else:
+            lines.append(rng.choice(C_INSTRUCTIONS))
+    return lines
+
+
+def bench_assembler(args):
+    line_count = args.lines
+    lines = generate_input(line_count)
+    start = time.perf_counter()
+    legacy_out = io.StringIO()
+    legacy_assemble(lines, legacy_out)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    out = io.StringIO()
+    assembler.write_hack(assembler.assemble(lines), out)
+    current = time.perf_counter() - start
+
+    assert out.getvalue() == legacy_out.getvalue()
+    print('assembler: %d lines, legacy %.3fs, table-driven %.3fs (%.1fx)' % (
+        line_count, legacy, current, legacy / current
+    ))
+
+
+def time_runs(cpu, run, repeat, max_cycles):
+    cycles = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        cpu.reset()
+        cycles += run(max_cycles)
+    return cycles, time.perf_counter() - start
+
+
+def bench_emulator(args):
+    """
+    Per-instruction interpreter against compiled basic blocks, running
+    each program `repeat` times; blocks compiled on the first run are
+    reused by the later ones. With --hle both run the Jack OS routines
+    natively, so the cycles measure the user code.
+    """
+    print('%-24s %6s %10s %12s %12s %8s' % (
+        'program', 'rom', 'cycles', 'interpreted', 'compiled', 'speedup'
+    ))
+    for path in args.paths:
+        rom = emulator.load_rom(path)
+        interpreted = emulator.HackEmulator(rom)
+        compiled = emulator.HackEmulator(rom)
+        if args.hle:
+            symbols = emulator.load_symbols(path)
+            interpreted.enable_hle(symbols)
+            compiled.enable_hle(symbols)
+        cycles, interpreted_time = time_runs(
+            interpreted, interpreted.run, args.repeat, args.cycles
+        )
+        _, compiled_time = time_runs(
+            compiled, compiled.run_compiled, args.repeat, args.cycles
+        )
+        assert interpreted.ram == compiled.ram
+        print('%-24s %6d %10d %7.2f MIPS %7.2f MIPS %7.1fx' % (
+            os.path.basename(path), len(rom), cycles // args.repeat,
+            cycles / interpreted_time / 1e6, cycles / compiled_time / 1e6,
+            interpreted_time / compiled_time
+        ))
+
+
+BENCHMARKS = {
+    'assembler': bench_assembler,
+    'emulator': bench_emulator
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        '--lines', type=int, default=1000000,
+        help='number of lines in the generated .asm input'
+    )
+    parser.add_argument(
+        'paths', nargs='*',
+        help='.asm, .hack or .bin programs for the emulator benchmark, '
+             'e.g. the project 8 FibonacciElement and StaticsTest output'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=200,
+        help='number of times the emulator benchmark runs each program'
+    )
+    parser.add_argument(
+        '--cycles', type=int, default=10 ** 7,
+        help='cycle budget for each emulated run'
+    )
+    parser.add_argument(
+        '--hle', action='store_true',
+        help='emulate the Jack OS routines natively in the emulator benchmark'
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,490 @@
+import argparse
+import os
+import time
+from array import array
+
+import assembler
+
+RAM_SIZE = 32768
+ADDRESS_MASK = RAM_SIZE - 1
+
+# pre-decoded C-instruction layout:
+# C_FLAG | comp index << 6 | dest (A D M) << 3 | jump (< = >)
+C_FLAG = 1 << 16
+# set on the entry of a function replaced by a native implementation
+TRAP_FLAG = 1 << 17
+DEST_A = 0x20
+DEST_D = 0x10
+DEST_M = 0x08
+
+
+def comp_expression(mnemonic):
+    expression = mnemonic.replace('!', '~').replace('A', 'a')
+    return expression.replace('D', 'd').replace('M', 'm')
+
+
+def comp_function(mnemonic):
+    return eval('lambda a, d, m: ' + comp_expression(mnemonic))
+
+
+def build_comp_table():
+    """
+    Dense list of comp mnemonics plus a map from the 7 a+comp bits of an
+    instruction to the mnemonic's index in that list
+    """
+    mnemonics = []
+    index_of = {}
+    for mnemonic, bits in sorted(assembler.COMP_LOOKUP.items()):
+        code = int(bits, 2)
+        if code in index_of:
+            # commutative spelling of a computation already listed
+            continue
+        index_of[code] = len(mnemonics)
+        mnemonics.append(mnemonic)
+        if 'A' in mnemonic:
+            index_of[code | 0x40] = len(mnemonics)
+            mnemonics.append(mnemonic.replace('A', 'M'))
+    return mnemonics, index_of
+
+
+COMP_MNEMONICS, COMP_INDEX = build_comp_table()
+COMP_FUNCTIONS = [comp_function(mnemonic) for mnemonic in COMP_MNEMONICS]
+
+
+JUMP_CONDITIONS = (None, 'v > 0', 'v == 0', 'v >= 0', 'v < 0', 'v != 0',
+                   'v <= 0', None)
+
+# computations whose result is always a 16-bit signed value already
+IN_RANGE = frozenset((
+    '0', '1', '-1', 'D', 'A', 'M', '!D', '!A', '!M',
+    'D&A', 'D|A', 'D&M', 'D|M'
+))
+
+
+def decode(word, address=None):
+    if not word & 0x8000:
+        return word
+    try:
+        comp = COMP_INDEX[(word >> 6) & 0x7f]
+    except KeyError:
+        raise ValueError('Invalid instruction %s at ROM[%s]' % (
+            '{:016b}'.format(word), address
+        ))
+    return C_FLAG | comp << 6 | word & 0x3f
+
+
+def find_leaders(code):
+    """
+    Addresses that start a basic block: the entry point, every
+    instruction after a jump and every `@L` loaded right before a jump
+    """
+    leaders = {0}
+    for address, op in enumerate(code):
+        if op >= C_FLAG and op & 7:
+            leaders.add(address + 1)
+            if address and code[address - 1] < C_FLAG:
+                leaders.add(code[address - 1])
+    return leaders
+
+
+def block_source(code, start, leaders):
+    """
+    Python source for the basic block at `start` as a function taking
+    (ram, a, d) and returning (next pc, a, d). A halt loop returns the
+    complement of its jump address. Addresses of A-instructions are
+    folded into the code that uses them.
+    """
+    lines = ['def block_%d(ram, a, d):' % start]
+    known = None
+    jump = 0
+    address = start
+    while address < len(code):
+        if address != start and address in leaders:
+            break
+        op = code[address]
+        address += 1
+        if op < C_FLAG:
+            known = op
+            continue
+        mnemonic = COMP_MNEMONICS[(op >> 6) & 0x3ff]
+        if known is None:
+            a_value, m_address = 'a', 'a & %d' % ADDRESS_MASK
+        else:
+            a_value, m_address = str(known), str(known & ADDRESS_MASK)
+        expression = mnemonic.replace('!', '~').replace('D', 'd')
+        expression = expression.replace('A', a_value)
+        expression = expression.replace('M', 'ram[%s]' % m_address)
+        if mnemonic not in IN_RANGE:
+            expression = '((%s) + 32768 & 65535) - 32768' % expression
+        jump = op & 7
+        targets = []
+        if op & DEST_M:
+            targets.append('ram[%s]' % m_address)
+        if op & DEST_D:
+            targets.append('d')
+        if op & DEST_A:
+            if jump and known is None:
+                lines.append('    t = a')
+                a_value = 't'
+            targets.append('a')
+        if jump:
+            targets.append('v')
+        if targets:
+            lines.append('    %s = %s' % (' = '.join(targets), expression))
+        if op & DEST_A:
+            known = None
+        if jump:
+            break
+    a_final = 'a' if known is None else str(known)
+    if jump:
+        if a_value.isdigit():
+            target = int(a_value) & ADDRESS_MASK
+            if target == address - 2 and code[target] == target:
+                target = ~(address - 1)
+        else:
+            target = '%s & %d' % (a_value, ADDRESS_MASK)
+        taken = '    return %s, %s, d' % (target, a_final)
+        if JUMP_CONDITIONS[jump] is None:
+            lines.append(taken)
+            return '\n'.join(lines) + '\n', address - start
+        lines.append('    if %s:' % JUMP_CONDITIONS[jump])
+        lines.append('    ' + taken)
+    lines.append('    return %d, %s, d' % (address, a_final))
+    return '\n'.join(lines) + '\n', address - start
+
+
+def wrap(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+
+def jack_divide(x, y):
+    quotient = abs(x) // abs(y)
+    return wrap(-quotient if (x < 0) != (y < 0) else quotient)
+
+
+def math_multiply(ram, statics, x, y):
+    return wrap(x * y)
+
+
+def math_divide(ram, statics, x, y):
+    if not y:
+        raise ZeroDivisionError('Math.divide(%d, 0)' % x)
+    return jack_divide(x, y)
+
+
+def memory_alloc(ram, statics, size):
+    """
+    First fit over Memory's free list, making the same RAM writes as
+    project 12's Memory.alloc
+    """
+    free_list, = statics
+    size_required = size + 2
+    address = ram[free_list]
+    last_block = 0
+    while address:
+        block_size = ram[address + 1]
+        next_block = ram[address]
+        if block_size >= size:
+            if block_size - size < 2:
+                if last_block:
+                    ram[last_block] = next_block
+                elif next_block:
+                    ram[free_list] = next_block
+            else:
+                next_part = address + size_required
+                ram[address + 1] = size
+                if last_block:
+                    ram[last_block] = next_part
+                else:
+                    ram[free_list] = next_part
+                ram[next_part] = next_block
+                ram[next_part + 1] = wrap(block_size - size_required)
+            return wrap(address + 2)
+        last_block = address
+        address = next_block
+    return 0
+
+
+def output_print_char(ram, statics, c):
+    """
+    Draw `c` into the screen memory map the way project 12's
+    Output.printChar does and advance the cursor
+    """
+    (char_maps, screen_base, cursor_x, cursor_y, left_slot_mask,
+     right_slot_mask, col_size) = [ram[address] for address in statics[:7]]
+    if cursor_y > 63 * col_size:
+        cursor_x = cursor_y = 0
+        ram[statics[2]] = ram[statics[3]] = 0
+    column = jack_divide(cursor_y, 16)
+    if cursor_y - column * 16 == 0:
+        clear_mask = left_slot_mask
+    else:
+        clear_mask = right_slot_mask
+    if c < 32 or c > 126:
+        c = 0
+    char_repr = ram[(char_maps + c) & ADDRESS_MASK]
+    for j in range(11):
+        address = (screen_base + wrap(32 * (cursor_x + j) + column)) \
+            & ADDRESS_MASK
+        value = ram[(char_repr + j) & ADDRESS_MASK]
+        if clear_mask == right_slot_mask:
+            value = wrap(value * 256)
+        ram[address] = value | ram[address] & clear_mask
+    ram[statics[3]] = wrap(cursor_y + col_size)
+    return 0
+
+
+# function label -> (native implementation, argument count, statics used)
+OS_ROUTINES = {
+    'Math.multiply': (math_multiply, 2, ()),
+    'Math.divide': (math_divide, 2, ()),
+    'Memory.alloc': (memory_alloc, 1, ('Memory.1',)),
+    'Output.printChar': (output_print_char, 1, tuple(
+        'Output.%d' % index for index in range(7)
+    ))
+}
+
+
+def native_return(ram, value):
+    """
+    VM `return` of `value` from the current frame with the register
+    effects of the translator's return sequence, giving (pc, a, d)
+    """
+    frame = ram[1]
+    return_address = ram[frame - 5]
+    argument = ram[2]
+    ram[argument] = value
+    ram[0] = argument + 1
+    ram[4] = ram[frame - 1]
+    ram[3] = ram[frame - 2]
+    ram[2] = ram[frame - 3]
+    ram[1] = ram[frame - 4]
+    ram[13] = frame - 4
+    ram[14] = return_address
+    return return_address & ADDRESS_MASK, return_address, ram[1]
+
+
+def load_rom(path):
+    """
+    Read a program as 16-bit words from .hack text, a packed .bin
+    image or .asm source
+    """
+    if path.endswith('.bin'):
+        return assembler.load_bin(path)
+    with open(path) as f:
+        if path.endswith('.asm'):
+            return assembler.assemble(f)
+        return [int(line, 2) for line in f if line.strip()]
+
+
+def load_symbols(path):
+    """
+    Symbol table of the .asm source a program was assembled from
+    """
+    symbols = {}
+    with open(os.path.splitext(path)[0] + '.asm') as f:
+        assembler.assemble(f, symbols)
+    return symbols
+
+
+class HackEmulator(object):
+    """
+    Hack CPU running a ROM that was decoded once up front: the inner
+    loop only indexes prebuilt lists and the RAM array
+    """
+    def __init__(self, rom):
+        words = array('H', rom)
+        self.rom = array('h', words.tobytes())
+        self.code = [
+            decode(word, address) for address, word in enumerate(words)
+        ]
+        self.leaders = find_leaders(self.code)
+        self.blocks = [None] * len(self.code)
+        # entry address -> (native implementation, argument count, statics)
+        self.traps = {}
+        self.reset()
+
+    def enable_hle(self, symbols):
+        """
+        Run the OS routines in OS_ROUTINES natively whenever a call enters
+        their function label, returns the names of those replaced
+        """
+        replaced = []
+        for name, (function, argument_count, statics) in sorted(
+            OS_ROUTINES.items()
+        ):
+            if name not in symbols or not all(
+                static in symbols for static in statics
+            ):
+                continue
+            address = symbols[name]
+            self.traps[address] = (function, argument_count, tuple(
+                symbols[static] for static in statics
+            ))
+            self.code[address] |= TRAP_FLAG
+            self.leaders.add(address)
+            replaced.append(name)
+        self.blocks = [None] * len(self.code)
+        return replaced
+
+    def call_native(self, address):
+        self.native_calls += 1
+        function, argument_count, statics = self.traps[address]
+        ram = self.ram
+        argument = ram[2]
+        value = function(ram, statics, *ram[argument:argument + argument_count])
+        return native_return(ram, value)
+
+    def reset(self):
+        """
+        Clear RAM and registers, keeping the blocks compiled so far
+        """
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+        self.a = self.d = self.pc = 0
+        self.cycles = 0
+        self.native_calls = 0
+        self.halted = False
+
+    def run(self, max_cycles, stop_address=None):
+        """
+        Execute at most max_cycles instructions, stopping early when the
+        program runs off the end of ROM, spins in a `(L) @L 0;JMP` loop or
+        stores a non-zero value at stop_address
+        """
+        if self.halted:
+            return 0
+        code = self.code
+        ram = self.ram
+        comp_functions = COMP_FUNCTIONS
+        size = len(code)
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+        while cycles < max_cycles:
+            if pc >= size:
+                self.halted = True
+                break
+            op = code[pc]
+            cycles += 1
+            if op < C_FLAG:
+                a = op
+                pc += 1
+                continue
+            if op >= TRAP_FLAG:
+                pc, a, d = self.call_native(pc)
+                continue
+            value = comp_functions[(op >> 6) & 0x3ff](
+                a, d, ram[a & ADDRESS_MASK]
+            )
+            value = ((value + 0x8000) & 0xffff) - 0x8000
+            target = a
+            if op & DEST_M:
+                ram[a & ADDRESS_MASK] = value
+                if a == stop_address and value:
+                    self.halted = True
+                    pc += 1
+                    break
+            if op & DEST_A:
+                a = value
+            if op & DEST_D:
+                d = value
+            jump = op & 7
+            if jump and jump & (4 if value < 0 else 2 if value == 0 else 1):
+                if target == pc - 1 and code[target] == target:
+                    self.halted = True
+                    break
+                pc = target & ADDRESS_MASK
+            else:
+                pc += 1
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        return cycles
+
+    def compile_block(self, start):
+        if start in self.traps:
+            self.blocks[start] = block = (
+                lambda ram, a, d: self.call_native(start), 1
+            )
+            return block
+        source, length = block_source(self.code, start, self.leaders)
+        namespace = {}
+        exec(source, namespace)
+        self.blocks[start] = block = (
+            namespace['block_%d' % start], length
+        )
+        return block
+
+    def run_compiled(self, max_cycles):
+        """
+        Same as run() but executes whole basic blocks compiled to Python
+        functions, finishing with run() once the budget is too small for
+        the next block
+        """
+        if self.halted:
+            return 0
+        blocks = self.blocks
+        ram = self.ram
+        size = len(blocks)
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+        while pc < size:
+            block, length = blocks[pc] or self.compile_block(pc)
+            if cycles + length > max_cycles:
+                break
+            pc, a, d = block(ram, a, d)
+            cycles += length
+            if pc < 0:
+                pc = ~pc
+                self.halted = True
+                break
+        else:
+            self.halted = True
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        if not self.halted and cycles < max_cycles:
+            cycles += self.run(max_cycles - cycles)
+        return cycles
+
+
+def main(path, max_cycles, addresses, compiled=False, hle=False):
+    emulator = HackEmulator(load_rom(path))
+    if hle:
+        replaced = emulator.enable_hle(load_symbols(path))
+        print('native: %s' % (', '.join(replaced) or 'none'))
+    start = time.perf_counter()
+    if compiled:
+        cycles = emulator.run_compiled(max_cycles)
+    else:
+        cycles = emulator.run(max_cycles)
+    elapsed = time.perf_counter() - start
+    print('%d cycles in %.3fs, %.2f MIPS%s' % (
+        cycles, elapsed, cycles / elapsed / 1e6 if elapsed else 0,
+        ', halted' if emulator.halted else ''
+    ))
+    if hle:
+        print('%d native OS calls' % emulator.native_calls)
+    for address in addresses:
+        print('RAM[%d] = %d' % (address, emulator.ram[address]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='.hack, .bin or .asm program to run')
+    parser.add_argument(
+        '--cycles', type=int, default=10 ** 7,
+        help='maximum number of instructions to execute'
+    )
+    parser.add_argument(
+        '--ram', type=int, nargs='*', default=[],
+        help='RAM addresses to print once the program stops'
+    )
+    parser.add_argument(
+        '--compile', action='store_true',
+        help='run basic blocks compiled to Python instead of interpreting'
+    )
+    parser.add_argument(
+        '--hle', action='store_true',
+        help='run Jack OS routines natively, using the symbols of the '
+             '.asm source next to the program'
+    )
+    args = parser.parse_args()
+    main(args.path, args.cycles, args.ram, args.compile, args.hle)
@@ -1,9 +1,32 @@
-import sys
+import argparse
+import os
 import re
+import struct
 
-FILE = open(sys.argv[1])
 COUNT = 0
-CLASS_NAME = FILE.name.split('/')[-1].rstrip('.vm')
+CLASS_NAME = None
+# emit eq/lt/gt as jumps into shared $eq/$lt/$gt routines
+SHARED_COMPARE = False
+
+COMPARE_JUMPS = {
+    'eq': 'JEQ',
+    'lt': 'JLT',
+    'gt': 'JGT'
+}
+
+# binary VM files (.vmb), see read_bytecode in project 8's translator;
+# this stage handles the memory access and arithmetic commands only
+BYTECODE_MAGIC = b'VMB\x02'
+BYTECODE_RECORD = struct.Struct('<BHH')
+BYTECODE_STRING_LENGTH = struct.Struct('<H')
+BYTECODE_COMMANDS = (
+    'push', 'pop', 'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not',
+    'label', 'goto', 'if-goto', 'function', 'call', 'return'
+)
+BYTECODE_SEGMENTS = (
+    'constant', 'argument', 'local', 'static', 'this', 'that', 'pointer',
+    'temp'
+)
 
 MEMORY_SEGMENTS = {
     'local': 'LCL',
@@ -227,70 +250,47 @@ def bitwise_not():
     ])
 
 
-def eq():
-    global COUNT
-    translated = '\n'.join([
-        '// eq',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@SP',
-        'A=M-1',
-        'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JEQ',
-        '(SET_FALSE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=0',
-        '@CONT_%s' % COUNT,
+def shared_compare(command, label_id):
+    return '\n'.join([
+        '// %s' % command,
+        '@CONT_%s' % label_id,
+        'D=A',
+        '@$%s' % command,
         '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=-1',
-        '(CONT_%s)' % COUNT
+        '(CONT_%s)' % label_id
     ])
-    COUNT += 1
-    return translated
 
 
-def lt():
-    global COUNT
-    translated = '\n'.join([
-        '// lt',
+def write_compare_routine(command):
+    """
+    Shared body of eq/lt/gt, entered with the return address in D
+    """
+    return '\n'.join([
+        '// shared %s routine' % command,
+        '($%s)' % command,
+        '@R15',
+        'M=D',
         '@SP',
-        'A=M-1',
+        'AM=M-1',
         'D=M',
-        '@SP',
-        'M=M-1',
-        '@SP',
-        'A=M-1',
+        'A=A-1',
         'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JLT',
-        '(SET_FALSE_%s)' % COUNT,
+        'M=-1',
+        '@$%s$true' % command,
+        'D;%s' % COMPARE_JUMPS[command],
         '@SP',
         'A=M-1',
         'M=0',
-        '@CONT_%s' % COUNT,
-        '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=-1',
-        '(CONT_%s)' % COUNT
+        '($%s$true)' % command,
+        '@R15',
+        'A=M',
+        '0;JMP'
     ])
-    COUNT += 1
-    return translated
 
 
-def gt():
-    global COUNT
-    translated = '\n'.join([
-        '// lt',
+def inline_compare(command, label_id):
+    return '\n'.join([
+        '// %s' % command,
         '@SP',
         'A=M-1',
         'D=M',
@@ -299,24 +299,44 @@ def gt():
         '@SP',
         'A=M-1',
         'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JGT',
-        '(SET_FALSE_%s)' % COUNT,
+        '@SET_TRUE_%s' % label_id,
+        'D;%s' % COMPARE_JUMPS[command],
+        '(SET_FALSE_%s)' % label_id,
         '@SP',
         'A=M-1',
         'M=0',
-        '@CONT_%s' % COUNT,
+        '@CONT_%s' % label_id,
         '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
+        '(SET_TRUE_%s)' % label_id,
         '@SP',
         'A=M-1',
         'M=-1',
-        '(CONT_%s)' % COUNT
+        '(CONT_%s)' % label_id
     ])
+
+
+def compare(command):
+    global COUNT
+    if SHARED_COMPARE:
+        translated = shared_compare(command, COUNT)
+    else:
+        translated = inline_compare(command, COUNT)
     COUNT += 1
     return translated
 
 
+def eq():
+    return compare('eq')
+
+
+def lt():
+    return compare('lt')
+
+
+def gt():
+    return compare('gt')
+
+
 def remove_whitespace(line):
     return line.replace(' ', '').split('//')[0].strip()
 
@@ -377,12 +397,153 @@ def translate(line):
     raise NotImplementedError(line)
 
 
-new_file = open(FILE.name.rstrip('.vm') + '.asm', 'w')
-for line in FILE:
-    parsed_line = remove_whitespace(line)
-    if parsed_line:
-        translated_line = translate(parsed_line)
-        new_file.write(translated_line)
+ARITHMETIC_COMMANDS = {
+    'add': add,
+    'sub': sub,
+    'neg': neg,
+    'eq': eq,
+    'gt': gt,
+    'lt': lt,
+    'and': bitwise_and,
+    'or': bitwise_or,
+    'not': bitwise_not
+}
 
-new_file.close()
-FILE.close()
+
+def translate_command(command, segment=None, i=None):
+    """
+    Translate a command that is already split up, such as the
+    ('push', 'constant', 7) tuples read_bytecode() returns
+    """
+    if command == 'push':
+        if segment == 'constant':
+            return push_constant(i)
+        elif segment == 'temp':
+            return push_temp(i)
+        elif segment == 'pointer':
+            return push_pointer(str(i))
+        elif segment == 'static':
+            return push_static(i)
+        return push(segment, i)
+    elif command == 'pop':
+        if segment == 'temp':
+            return pop_temp(i)
+        elif segment == 'pointer':
+            return pop_pointer(str(i))
+        elif segment == 'static':
+            return pop_static(i)
+        return pop(segment, i)
+    elif command in ARITHMETIC_COMMANDS:
+        return ARITHMETIC_COMMANDS[command]()
+
+    raise NotImplementedError(command)
+
+
+def read_bytecode(f):
+    """
+    Decode a .vmb file, read in one go, into (command, segment, i)
+    tuples
+    """
+    data = f.read()
+    if data[:4] != BYTECODE_MAGIC:
+        raise ValueError('%s is not a VM bytecode file' % f.name)
+    string_count, = struct.unpack_from('<H', data, 4)
+    offset = 6
+    for _ in range(string_count):
+        length, = BYTECODE_STRING_LENGTH.unpack_from(data, offset)
+        offset += BYTECODE_STRING_LENGTH.size + length
+    commands = []
+    for opcode, segment, operand in BYTECODE_RECORD.iter_unpack(
+        memoryview(data)[offset:]
+    ):
+        command = BYTECODE_COMMANDS[opcode]
+        if command in ('push', 'pop'):
+            commands.append((command, BYTECODE_SEGMENTS[segment], operand))
+        else:
+            commands.append((command, None, None))
+    return commands
+
+
+def translate_file(path):
+    """
+    (command, translated) for each command of a .vm or .vmb file
+    """
+    if path.endswith('.vmb'):
+        with open(path, 'rb') as f:
+            commands = read_bytecode(f)
+        for command, segment, i in commands:
+            yield command, translate_command(command, segment, i)
+        return
+    with open(path) as f:
+        for line in f:
+            parsed_line = remove_whitespace(line)
+            if parsed_line:
+                yield parsed_line, translate(parsed_line)
+
+
+def write_halt():
+    return '\n'.join([
+        '// halt, never fall through into the shared routines',
+        '($halt)',
+        '@$halt',
+        '0;JMP'
+    ])
+
+
+def count_instructions(translated):
+    return sum(
+        1 for line in translated.split('\n')
+        if line and not line.startswith('//') and not line.startswith('(')
+    )
+
+
+def report_shared_compare(rom_size, comparisons):
+    # sizes do not depend on the command or label, measure one of each
+    saved = sum(comparisons.values()) * (
+        count_instructions(inline_compare('eq', 0)) -
+        count_instructions(shared_compare('eq', 0))
+    ) - sum(
+        count_instructions(write_compare_routine(command))
+        for command in comparisons
+    ) - count_instructions(write_halt())
+    print('comparisons: %d comparisons' % sum(comparisons.values()))
+    print('ROM: %d instructions, %d inline (saved %d)' % (
+        rom_size, rom_size + saved, saved
+    ))
+
+
+def main(path, shared_compare=False):
+    global CLASS_NAME, SHARED_COMPARE
+    SHARED_COMPARE = shared_compare
+    base_path = os.path.splitext(path)[0]
+    CLASS_NAME = os.path.basename(base_path)
+    new_file = open(base_path + '.asm', 'w')
+    rom_size = 0
+    comparisons = {}
+    for command, translated_line in translate_file(path):
+        new_file.write(translated_line)
+        rom_size += count_instructions(translated_line)
+        if command in COMPARE_JUMPS:
+            comparisons[command] = comparisons.get(command, 0) + 1
+
+    if shared_compare and comparisons:
+        routines = '\n'.join([write_halt()] + [
+            write_compare_routine(command) for command in sorted(comparisons)
+        ])
+        new_file.write('\n' + routines + '\n')
+        rom_size += count_instructions(routines)
+    new_file.close()
+    if shared_compare and comparisons:
+        report_shared_compare(rom_size, comparisons)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='.vm or .vmb file to translate')
+    parser.add_argument(
+        '--shared-compare', action='store_true',
+        help='jump into one shared routine per eq/lt/gt instead of '
+             'inlining the comparison at every site'
+    )
+    args = parser.parse_args()
+    main(args.path, args.shared_compare)
@@ -0,0 +1,353 @@
+import argparse
+import sys
+import time
+
+import VMTranslator
+
+# opcodes, each instruction is an (opcode, x, y) tuple of ints
+PUSH_CONSTANT = 0   # x = value
+PUSH_DIRECT = 1     # x = RAM address (temp, pointer, static)
+PUSH_INDIRECT = 2   # x = pointer register, y = index
+POP_DIRECT = 3
+POP_INDIRECT = 4
+ADD = 5
+SUB = 6
+NEG = 7
+EQ = 8
+GT = 9
+LT = 10
+AND = 11
+OR = 12
+NOT = 13
+GOTO = 14           # x = target
+IF_GOTO = 15        # x = target
+FUNCTION = 16       # x = locals count
+CALL = 17           # x = target, y = args count
+RETURN = 18
+HALT = 19
+
+ARITHMETIC = {
+    'add': ADD,
+    'sub': SUB,
+    'neg': NEG,
+    'eq': EQ,
+    'gt': GT,
+    'lt': LT,
+    'and': AND,
+    'or': OR,
+    'not': NOT
+}
+
+POINTERS = {
+    'local': 1,
+    'argument': 2,
+    'this': 3,
+    'that': 4
+}
+
+# RAM[16..255], the same cells the assembler gives static variables
+STATIC_BASE = 16
+
+
+def wrap(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+
+def read_commands(filename):
+    """
+    (location, command, arg1, arg2) for each command of a .vm or .vmb
+    file, with arg2 as an int
+    """
+    if filename.endswith('.vmb'):
+        with open(filename, 'rb') as f:
+            commands = VMTranslator.read_bytecode(f)
+        for index, (command, arg1, arg2) in enumerate(commands):
+            yield '%s:#%d' % (filename, index), command, arg1, arg2
+        return
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            words = line.split('//')[0].split()
+            if not words:
+                continue
+            location = '%s:%d' % (filename, line_number)
+            if len(words) > 3 or len(words) == 3 and not words[2].isdigit():
+                raise ValueError('%s: cannot parse %s' % (
+                    location, line.strip()
+                ))
+            yield (
+                location, words[0],
+                words[1] if len(words) > 1 else None,
+                int(words[2]) if len(words) > 2 else None
+            )
+
+
+class VMProgram(object):
+    """
+    A set of .vm files parsed once into instruction tuples with label,
+    function and static references resolved to ints
+    """
+    def __init__(self, path):
+        self.instructions = []
+        self.functions = {}
+        self.statics = {}
+        labels = {}
+        # (instruction index, label or function name, location)
+        unresolved = []
+        # in the order the translator writes the files, which is the
+        # order the assembler allocates their statics in
+        for filename in sorted(VMTranslator.get_file_list(path)):
+            self.parse_file(
+                filename, VMTranslator.get_class_name(filename), labels,
+                unresolved
+            )
+        self.instructions.append((HALT, 0, 0))
+        for index, name, location in unresolved:
+            target = labels.get(name, self.functions.get(name))
+            if target is None:
+                raise ValueError('%s: unknown label or function %s' % (
+                    location, name.split('$')[-1]
+                ))
+            opcode, _, y = self.instructions[index]
+            self.instructions[index] = (opcode, target, y)
+
+    def static_address(self, class_name, i):
+        # in order of first reference, which is how the assembler
+        # allocates the variables of the translated program
+        name = '%s.%s' % (class_name, i)
+        if name not in self.statics:
+            self.statics[name] = STATIC_BASE + len(self.statics)
+        return self.statics[name]
+
+    def parse_file(self, filename, class_name, labels, unresolved):
+        instructions = self.instructions
+        current_function = None
+        for location, command, arg1, arg2 in read_commands(filename):
+            if command in ARITHMETIC and arg1 is None:
+                instructions.append((ARITHMETIC[command], 0, 0))
+            elif command in ('push', 'pop') and arg2 is not None:
+                instructions.append(self.parse_memory_access(
+                    command, arg1, arg2, class_name, location
+                ))
+            elif command in ('label', 'goto', 'if-goto') and (
+                arg1 is not None and arg2 is None
+            ):
+                if current_function:
+                    name = '%s$%s' % (current_function, arg1)
+                else:
+                    name = '%s.%s' % (class_name, arg1)
+                if command == 'label':
+                    labels[name] = len(instructions)
+                    continue
+                unresolved.append((len(instructions), name, location))
+                opcode = GOTO if command == 'goto' else IF_GOTO
+                instructions.append((opcode, None, 0))
+            elif command == 'function' and arg2 is not None:
+                current_function = arg1
+                self.functions[current_function] = len(instructions)
+                instructions.append((FUNCTION, arg2, 0))
+            elif command == 'call' and arg2 is not None:
+                unresolved.append((len(instructions), arg1, location))
+                instructions.append((CALL, None, arg2))
+            elif command == 'return' and arg1 is None:
+                instructions.append((RETURN, 0, 0))
+            else:
+                raise ValueError('%s: cannot parse %s' % (
+                    location, ' '.join(
+                        str(word) for word in (command, arg1, arg2)
+                        if word is not None
+                    )
+                ))
+
+    def parse_memory_access(self, command, segment, i, class_name, location):
+        if segment == 'constant' and command == 'push':
+            return (PUSH_CONSTANT, wrap(i), 0)
+        if segment in POINTERS:
+            opcode = PUSH_INDIRECT if command == 'push' else POP_INDIRECT
+            return (opcode, POINTERS[segment], i)
+        if segment == 'temp':
+            address = VMTranslator.MEMORY_SEGMENTS['temp'] + i
+        elif segment == 'pointer' and i in (0, 1):
+            address = 3 + i
+        elif segment == 'static':
+            address = self.static_address(class_name, i)
+        else:
+            raise ValueError('%s: cannot %s %s %d' % (
+                location, command, segment, i
+            ))
+        opcode = PUSH_DIRECT if command == 'push' else POP_DIRECT
+        return (opcode, address, 0)
+
+
+class VMInterpreter(object):
+    """
+    Executes a VMProgram over the Hack RAM layout: SP, LCL, ARG, THIS
+    and THAT in RAM[0..4], temp in RAM[5..12], statics from RAM[16] and
+    frames with the translator's calling convention. Saved return
+    addresses are instruction indexes rather than ROM addresses, and
+    the R13-R15 scratch cells are not used. SP is cached while running
+    and stored back to RAM[0] on calls, returns and when run() stops.
+    """
+    def __init__(self, program, ram=None):
+        self.program = program
+        self.ram = [0] * 32768
+        for address, value in (ram or {}).items():
+            self.ram[address] = value
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        if 'Sys.init' in program.functions:
+            self.bootstrap()
+
+    def bootstrap(self):
+        """
+        SP = 256 and call Sys.init, returning into the final HALT
+        """
+        ram = self.ram
+        halt = len(self.program.instructions) - 1
+        ram[256:261] = [halt] + ram[1:5]
+        ram[0] = 261
+        ram[2] = 256
+        ram[1] = 261
+        self.pc = self.program.functions['Sys.init']
+
+    def run(self, max_steps):
+        """
+        Execute at most max_steps VM commands, returns how many ran
+        """
+        if self.halted:
+            return 0
+        instructions = self.program.instructions
+        # the final HALT, where a return to a saved address outside the
+        # program ends up, as when the project 8 tests set one
+        halt = len(instructions) - 1
+        ram = self.ram
+        pc = self.pc
+        sp = ram[0]
+        steps = 0
+        while steps < max_steps:
+            opcode, x, y = instructions[pc]
+            pc += 1
+            steps += 1
+            if opcode == PUSH_CONSTANT:
+                ram[sp] = x
+                sp += 1
+            elif opcode == PUSH_INDIRECT:
+                ram[sp] = ram[ram[x] + y]
+                sp += 1
+            elif opcode == PUSH_DIRECT:
+                ram[sp] = ram[x]
+                sp += 1
+            elif opcode == POP_INDIRECT:
+                sp -= 1
+                ram[ram[x] + y] = ram[sp]
+            elif opcode == POP_DIRECT:
+                sp -= 1
+                ram[x] = ram[sp]
+            elif opcode == ADD:
+                sp -= 1
+                ram[sp - 1] = wrap(ram[sp - 1] + ram[sp])
+            elif opcode == SUB:
+                sp -= 1
+                ram[sp - 1] = wrap(ram[sp - 1] - ram[sp])
+            elif opcode == IF_GOTO:
+                sp -= 1
+                if ram[sp]:
+                    pc = x
+            elif opcode == GOTO:
+                pc = x
+            elif opcode <= LT:
+                if opcode == NEG:
+                    ram[sp - 1] = wrap(-ram[sp - 1])
+                    continue
+                sp -= 1
+                # the translated code compares the sign of x - y
+                difference = wrap(ram[sp - 1] - ram[sp])
+                if opcode == EQ:
+                    result = difference == 0
+                elif opcode == GT:
+                    result = difference > 0
+                else:
+                    result = difference < 0
+                ram[sp - 1] = -1 if result else 0
+            elif opcode == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif opcode == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif opcode == NOT:
+                ram[sp - 1] = ~ram[sp - 1]
+            elif opcode == FUNCTION:
+                ram[sp:sp + x] = [0] * x
+                sp += x
+            elif opcode == CALL:
+                ram[sp:sp + 5] = [pc] + ram[1:5]
+                sp += 5
+                ram[2] = sp - 5 - y
+                ram[1] = sp
+                pc = x
+            elif opcode == RETURN:
+                frame = ram[1]
+                pc = ram[frame - 5]
+                if not 0 <= pc < halt:
+                    pc = halt
+                argument = ram[2]
+                ram[argument] = ram[sp - 1]
+                sp = argument + 1
+                ram[1:5] = ram[frame - 4:frame]
+            else:
+                pc -= 1
+                steps -= 1
+                self.halted = True
+                break
+        ram[0] = sp
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+
+def parse_ram(assignments):
+    ram = {}
+    for assignment in assignments:
+        address, value = assignment.split('=')
+        ram[int(address)] = int(value)
+    return ram
+
+
+def main(path, max_steps, addresses, ram):
+    start = time.perf_counter()
+    program = VMProgram(path)
+    parsed = time.perf_counter()
+    interpreter = VMInterpreter(program, ram)
+    steps = interpreter.run(max_steps)
+    elapsed = time.perf_counter() - parsed
+    print('%d commands parsed in %.3fs, %d steps in %.3fs%s' % (
+        len(program.instructions) - 1, parsed - start, steps, elapsed,
+        ', halted' if interpreter.halted else ''
+    ))
+    for address in addresses:
+        print('RAM[%d] = %d' % (address, interpreter.ram[address]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'path', help='.vm/.vmb file or directory of .vm/.vmb files'
+    )
+    parser.add_argument(
+        '--steps', type=int, default=10 ** 7,
+        help='maximum number of VM commands to execute'
+    )
+    parser.add_argument(
+        '--ram', type=int, nargs='*', default=[],
+        help='RAM addresses to print once the program stops'
+    )
+    parser.add_argument(
+        '--set', nargs='*', default=[], metavar='ADDRESS=VALUE',
+        help='initial RAM contents, e.g. 0=256 1=300 for the project 7 tests'
+    )
+    args = parser.parse_args()
+    try:
+        main(args.path, args.steps, args.ram, parse_ram(args.set))
+    except ValueError as error:
+        sys.exit(str(error))
@@ -1,25 +1,39 @@
+import argparse
+import functools
 import sys
-import re
 import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
 
-FILE_LIST = []
-path = sys.argv[1]
-IS_DIR = os.path.isdir(path)
-if not IS_DIR:
-    FILE_LIST.append(path)
-else:
-    if not path.endswith('/'):
-        path = path + '/'
-    for filename in os.listdir(path):
-        if filename.endswith('vm'):
-            path_to_file = os.path.join(path, filename)
-            FILE_LIST.append(path_to_file)
-
-
-COUNT = 0
-# FUNCTION_STACK = []
-CURRENT_FUNCTION = None
-CLASS_NAME = None
+import peephole
+
+
+# the assembler gives each static variable a cell in RAM[16..255]
+STATIC_SEGMENT_SIZE = 240
+
+COMPARE_JUMPS = {
+    'eq': 'JEQ',
+    'lt': 'JLT',
+    'gt': 'JGT'
+}
+
+# binary VM files (.vmb), all numbers little-endian: magic, u16 string
+# count, each string as a u16 length and ASCII bytes, then 5-byte records
+# up to the end of the file: u8 opcode, u16 segment (the count for
+# function and call) and u16 operand (a string table index for label
+# and function names)
+BYTECODE_MAGIC = b'VMB\x02'
+BYTECODE_RECORD = struct.Struct('<BHH')
+BYTECODE_STRING_LENGTH = struct.Struct('<H')
+BYTECODE_COMMANDS = (
+    'push', 'pop', 'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not',
+    'label', 'goto', 'if-goto', 'function', 'call', 'return'
+)
+BYTECODE_SEGMENTS = (
+    'constant', 'argument', 'local', 'static', 'this', 'that', 'pointer',
+    'temp'
+)
+BYTECODE_NAMED = ('label', 'goto', 'if-goto', 'function', 'call')
 
 MEMORY_SEGMENTS = {
     'local': 'LCL',
@@ -33,371 +47,444 @@ MEMORY_SEGMENTS = {
 }
 
 
-def push_constant(i):
-    return '\n'.join([
-        '// push constant %s' % i,
-        '@%s' % i,
-        'D=A',
-        '@SP',
-        'A=M',
-        'M=D',
-        '@SP',
-        'M=M+1'
-    ])
+# templates are joined once at import, translation only fills them in
+PUSH_D = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1']
+# pop the top of the stack into D
+POP_D = ['@SP', 'A=M-1', 'D=M', '@SP', 'M=M-1']
+
+PUSH_CONSTANT = '\n'.join([
+    '// push constant %s',
+    '@%s',
+    'D=A'
+] + PUSH_D)
+
+PUSH_POINTER = '\n'.join([
+    '// push pointer %s',
+    '@%s',
+    'D=M'
+] + PUSH_D)
+
+PUSH_STATIC = '\n'.join([
+    '// push static %s',
+    '@%s.%s',
+    'D=M'
+] + PUSH_D)
+
+PUSH_TEMP = '\n'.join([
+    '// push temp %s',
+    '@%s',
+    'D=M'
+] + PUSH_D)
+
+PUSH_SEGMENT = '\n'.join([
+    '// push %s %s',
+    '@%s',
+    'A=M',
+    'D=A',
+    '@%s',
+    'D=D+A',
+    'A=D',
+    'D=M'
+] + PUSH_D)
+
+POP_TEMP = '\n'.join([
+    '// pop temp %s',
+    # find value that we need to store
+    '@SP',
+    'A=M-1',
+    'D=M',
+    '@SP',
+    # decrement stack pointer
+    'M=M-1',
+    '@%s',
+    'M=D'
+])
+
+POP_POINTER = '\n'.join(['// pop pointer %s'] + POP_D + ['@%s', 'M=D'])
+
+POP_STATIC = '\n'.join(['// pop static %s'] + POP_D + ['@%s.%s', 'M=D'])
+
+POP_SEGMENT = '\n'.join([
+    '// pop %s %s',
+    # find value that we need to store
+    '@SP',
+    'A=M-1',
+    'D=M',
+    '@SP',
+    # decrement stack pointer
+    'M=M-1',
+    # store it in R13
+    '@R13',
+    'M=D',
+    '@%s',
+    'A=M',
+    'D=A',
+    '@%s',
+    'D=D+A',
+    # store address where to pop in R14
+    '@R14',
+    'M=D',
+    '@R13',
+    'D=M',
+    '@R14',
+    'A=M',
+    'M=D'
+])
+
+
+def binary_operation(command, operation):
+    return '\n'.join(
+        ['// %s' % command] + POP_D + ['A=M-1', 'M=%s' % operation]
+    )
 
 
-def push_pointer(i):
-    return '\n'.join([
-        '// push pointer %s' % i,
-        '@%s' % MEMORY_SEGMENTS[i],
-        'D=M',
-        '@SP',
-        'A=M',
-        'M=D',
-        '@SP',
-        'M=M+1'
-    ])
+def unary_operation(command, operation):
+    return '\n'.join(['// %s' % command, '@SP', 'A=M-1', 'M=%s' % operation])
 
 
-def push_static(i):
-    return '\n'.join([
-        '// push static %s' % i,
-        '@%s.%s' % (CLASS_NAME, i),
-        'D=M',
-        '@SP',
-        'A=M',
-        'M=D',
-        '@SP',
-        'M=M+1'
-    ])
+ADD = binary_operation('add', 'M+D')
+SUB = binary_operation('sub', 'M-D')
+OR = binary_operation('or', 'M|D')
+AND = binary_operation('and', 'M&D')
+NEG = unary_operation('neg', '-M')
+NOT = unary_operation('not', '!M')
 
 
-def push_temp(i):
-    return '\n'.join([
-        '// push temp %s' % i,
-        '@%s' % (MEMORY_SEGMENTS['temp'] + int(i)),
-        'D=M',
-        '@SP',
-        'A=M',
-        'M=D',
-        '@SP',
-        'M=M+1'
-    ])
+def push_constant(state, i):
+    return PUSH_CONSTANT % (i, i)
 
 
-def push(segment, i):
-    return '\n'.join([
-        '// push %s %s' % (segment, i),
-        '@%s' % MEMORY_SEGMENTS[segment],
-        'A=M',
-        'D=A',
-        '@%s' % i,
-        'D=D+A',
-        'A=D',
-        'D=M',
-        '@SP',
-        'A=M',
-        'M=D',
-        '@SP',
-        'M=M+1'
-    ])
+def push_pointer(state, i):
+    return PUSH_POINTER % (i, MEMORY_SEGMENTS[str(i)])
 
 
-def pop_temp(i):
-    return '\n'.join([
-        '// pop temp %s' % i,
-        # find value that we need to store
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        # decrement stack pointer
-        'M=M-1',
-        '@%s' % (MEMORY_SEGMENTS['temp'] + int(i)),
-        'M=D'
-    ])
+def push_static(state, i):
+    state.static_symbols.add('%s.%s' % (state.class_name, i))
+    return PUSH_STATIC % (i, state.class_name, i)
 
 
-def pop_pointer(i):
-    return '\n'.join([
-        '// pop pointer %s' % i,
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@%s' % MEMORY_SEGMENTS[i],
-        'M=D'
-    ])
+def push_temp(state, i):
+    return PUSH_TEMP % (i, MEMORY_SEGMENTS['temp'] + int(i))
 
 
-def pop_static(i):
-    return '\n'.join([
-        '// pop static %s' % i,
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@%s.%s' % (CLASS_NAME, i),
-        'M=D'
-    ])
+def push(segment, state, i):
+    if state.specialize_segments:
+        return push_specialized(segment, int(i))
+    return PUSH_SEGMENT % (segment, i, MEMORY_SEGMENTS[segment], i)
 
 
-def pop(segment, i):
-    return '\n'.join([
-        '// pop %s %s' % (segment, i),
-        # find value that we need to store
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        # decrement stack pointer
-        'M=M-1',
-        # store it in R13
-        '@R13',
-        'M=D',
-        '@%s' % MEMORY_SEGMENTS[segment],
-        'A=M',
-        'D=A',
-        '@%s' % i,
-        'D=D+A',
-        # store address where to pop in R14
-        '@R14',
-        'M=D',
-        '@R13',
-        'D=M',
-        '@R14',
-        'A=M',
-        'M=D'
-    ])
+def pop_temp(state, i):
+    return POP_TEMP % (i, MEMORY_SEGMENTS['temp'] + int(i))
 
 
-def add():
-    return '\n'.join([
-        '// add',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        'A=M-1',
-        'M=M+D'
-    ])
+def pop_pointer(state, i):
+    return POP_POINTER % (i, MEMORY_SEGMENTS[str(i)])
 
 
-def sub():
-    return '\n'.join([
-        '// sub',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        'A=M-1',
-        'M=M-D'
-    ])
+def pop_static(state, i):
+    state.static_symbols.add('%s.%s' % (state.class_name, i))
+    return POP_STATIC % (i, state.class_name, i)
 
 
-def bitwise_or():
-    return '\n'.join([
-        '// or',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        'A=M-1',
-        'M=M|D'
-    ])
+def pop(segment, state, i):
+    if state.specialize_segments:
+        return pop_specialized(segment, int(i))
+    return POP_SEGMENT % (segment, i, MEMORY_SEGMENTS[segment], i)
 
 
-def bitwise_and():
-    return '\n'.join([
-        '// and',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        'A=M-1',
-        'M=M&D'
-    ])
+# `@i / D=A / @LCL / A=D+M` takes 4 instructions for any i, counting
+# up from the base with A=M+1 and A=A+1 takes i + 1 and leaves D alone
+INDEXED_PUSH_LIMIT = 2
+# a pop through R13 takes 12 instructions, popping into D first and
+# counting up to the address takes i + 5 without touching R13
+DIRECT_POP_LIMIT = 6
 
 
-def neg():
-    return '\n'.join([
-        '// neg',
-        '@SP',
-        'A=M-1',
-        'M=-M'
-    ])
+def indexed_address(segment, i):
+    """
+    Instructions leaving the address of segment[i] in A without using D
+    """
+    base = '@%s' % MEMORY_SEGMENTS[segment]
+    if i == 0:
+        return [base, 'A=M']
+    return [base, 'A=M+1'] + ['A=A+1'] * (i - 1)
 
 
-def bitwise_not():
-    return '\n'.join([
-        '// not',
-        '@SP',
-        'A=M-1',
-        'M=!M'
-    ])
+def segment_address(segment, i):
+    """
+    Shortest instructions leaving the address of segment[i] in A, D is
+    overwritten for indexes past INDEXED_PUSH_LIMIT
+    """
+    if i <= INDEXED_PUSH_LIMIT:
+        return indexed_address(segment, i)
+    return ['@%s' % i, 'D=A', '@%s' % MEMORY_SEGMENTS[segment], 'A=D+M']
 
 
-def eq():
-    global COUNT
-    translated = '\n'.join([
-        '// eq',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@SP',
-        'A=M-1',
-        'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JEQ',
-        '(SET_FALSE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=0',
-        '@CONT_%s' % COUNT,
-        '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=-1',
-        '(CONT_%s)' % COUNT
-    ])
-    COUNT += 1
-    return translated
+def push_specialized(segment, i):
+    return '\n'.join(
+        ['// push %s %s' % (segment, i)] + segment_address(segment, i) +
+        ['D=M'] + PUSH_D
+    )
 
 
-def lt():
-    global COUNT
-    translated = '\n'.join([
-        '// lt',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@SP',
-        'A=M-1',
-        'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JLT',
-        '(SET_FALSE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=0',
-        '@CONT_%s' % COUNT,
-        '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=-1',
-        '(CONT_%s)' % COUNT
-    ])
-    COUNT += 1
-    return translated
+def pop_specialized(segment, i):
+    lines = ['// pop %s %s' % (segment, i)]
+    if i <= DIRECT_POP_LIMIT:
+        lines.extend(['@SP', 'AM=M-1', 'D=M'] + indexed_address(segment, i))
+    else:
+        lines.extend([
+            '@%s' % i,
+            'D=A',
+            '@%s' % MEMORY_SEGMENTS[segment],
+            'D=D+M',
+            '@R13',
+            'M=D',
+            '@SP',
+            'AM=M-1',
+            'D=M',
+            '@R13',
+            'A=M'
+        ])
+    lines.append('M=D')
+    return '\n'.join(lines)
+
+
+def add(state):
+    return ADD
+
+
+def sub(state):
+    return SUB
+
+
+def bitwise_or(state):
+    return OR
+
+
+def bitwise_and(state):
+    return AND
+
 
+def neg(state):
+    return NEG
 
-def gt():
-    global COUNT
-    translated = '\n'.join([
-        '// lt',
+
+def bitwise_not(state):
+    return NOT
+
+
+def next_label_id(state):
+    """
+    Suffix for the labels a command generates, namespaced by the class
+    being translated so that each file numbers its own labels from 0
+    """
+    label_id = '%s.%d' % (state.class_name, state.count)
+    state.count += 1
+    return label_id
+
+
+SHARED_COMPARE_CALL = '\n'.join([
+    '// %(command)s',
+    '@CONT_%(count)s',
+    'D=A',
+    '@$%(command)s',
+    '0;JMP',
+    '(CONT_%(count)s)'
+])
+
+
+def shared_compare(state, command):
+    return SHARED_COMPARE_CALL % {
+        'command': command,
+        'count': next_label_id(state)
+    }
+
+
+def write_compare_routine(command):
+    """
+    Shared body of eq/lt/gt, entered with the return address in D
+    """
+    return '\n'.join([
+        '// shared %s routine' % command,
+        '($%s)' % command,
+        '@R15',
+        'M=D',
         '@SP',
-        'A=M-1',
+        'AM=M-1',
         'D=M',
-        '@SP',
-        'M=M-1',
-        '@SP',
-        'A=M-1',
+        'A=A-1',
         'D=M-D',
-        '@SET_TRUE_%s' % COUNT,
-        'D;JGT',
-        '(SET_FALSE_%s)' % COUNT,
+        'M=-1',
+        '@$%s$true' % command,
+        'D;%s' % COMPARE_JUMPS[command],
         '@SP',
         'A=M-1',
         'M=0',
-        '@CONT_%s' % COUNT,
-        '0;JMP',
-        '(SET_TRUE_%s)' % COUNT,
-        '@SP',
-        'A=M-1',
-        'M=-1',
-        '(CONT_%s)' % COUNT
+        '($%s$true)' % command,
+        '@R15',
+        'A=M',
+        '0;JMP'
     ])
-    COUNT += 1
-    return translated
 
 
-def get_full_label_name(label_name):
-    if not CURRENT_FUNCTION:
-        return '%s.%s' % (CLASS_NAME, label_name)
-    return '%s$%s' % (CURRENT_FUNCTION, label_name)
+COMPARE = '\n'.join([
+    '// %(command)s',
+    '@SP',
+    'A=M-1',
+    'D=M',
+    '@SP',
+    'M=M-1',
+    '@SP',
+    'A=M-1',
+    'D=M-D',
+    '@SET_TRUE_%(count)s',
+    'D;%(jump)s',
+    '(SET_FALSE_%(count)s)',
+    '@SP',
+    'A=M-1',
+    'M=0',
+    '@CONT_%(count)s',
+    '0;JMP',
+    '(SET_TRUE_%(count)s)',
+    '@SP',
+    'A=M-1',
+    'M=-1',
+    '(CONT_%(count)s)'
+])
 
 
-def write_label(label_name):
-    return '(%s)' % get_full_label_name(label_name)
+def compare(state, command):
+    if state.shared_compare:
+        return shared_compare(state, command)
+    return COMPARE % {
+        'command': command,
+        'count': next_label_id(state),
+        'jump': COMPARE_JUMPS[command]
+    }
 
 
-def if_goto(label_name):
-    label_name = get_full_label_name(label_name)
-    translated = '\n'.join([
-        '// if-goto',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@SP',
-        'M=M-1',
-        '@%s' % label_name,
-        'D;JNE'
-    ])
-    return translated
+def eq(state):
+    return compare(state, 'eq')
 
 
-def goto(label_name):
-    label_name = get_full_label_name(label_name)
-    translated = '\n'.join([
-        '// goto',
-        '@%s' % label_name,
-        '0;JMP'
-    ])
-    return translated
+def lt(state):
+    return compare(state, 'lt')
 
 
-def write_function(function_name, locals_count):
-    global CURRENT_FUNCTION
-    generated_locals = [
-        push_constant('0')
-        for i in range(locals_count)
-    ]
-    translated = '\n'.join([
-        '// function %s %d' % (function_name, locals_count),
-        '(%s)' % function_name
-    ]) + '\n' + '\n'.join(generated_locals)
+def gt(state):
+    return compare(state, 'gt')
+
 
-    CURRENT_FUNCTION = function_name
+def get_full_label_name(state, label_name):
+    if not state.current_function:
+        return '%s.%s' % (state.class_name, label_name)
+    return '%s$%s' % (state.current_function, label_name)
+
+
+def write_label(state, label_name):
+    return '(%s)' % get_full_label_name(state, label_name)
+
+
+IF_GOTO = '\n'.join(['// if-goto'] + POP_D + ['@%s', 'D;JNE'])
+
+GOTO = '\n'.join(['// goto', '@%s', '0;JMP'])
+
+FUNCTION = '\n'.join(['// function %s %d', '(%s)'])
+
+PUSH_ZERO = PUSH_CONSTANT % (0, 0)
+
+# zeroing loop, 9 instructions whatever the count but 7 cycles a local
+ZERO_LOCALS_LOOP = '\n'.join([
+    '// zero %(count)d locals',
+    '@%(count)d',
+    'D=A',
+    '(%(label)s)',
+    '@SP',
+    'AM=M+1',
+    'A=A-1',
+    'M=0',
+    'D=D-1',
+    '@%(label)s',
+    'D;JGT'
+])
+
+
+def if_goto(state, label_name):
+    return IF_GOTO % get_full_label_name(state, label_name)
+
+
+def goto(state, label_name):
+    return GOTO % get_full_label_name(state, label_name)
+
+
+def compact_prologue(function_name, locals_count):
+    """
+    Zero locals_count stack entries with whichever is smaller: M=0
+    stores and a single SP update, or a loop
+    """
+    if locals_count == 0:
+        return ''
+    if locals_count == 1:
+        return '\n'.join(['// zero 1 local', '@SP', 'M=M+1', 'A=M-1', 'M=0'])
+    unrolled = '\n'.join(
+        ['// zero %d locals' % locals_count, '@SP', 'A=M', 'M=0'] +
+        ['A=A+1', 'M=0'] * (locals_count - 1) + ['D=A+1', '@SP', 'M=D']
+    )
+    loop = ZERO_LOCALS_LOOP % {
+        'count': locals_count,
+        # a $ cannot appear in a VM label, so this never collides
+        'label': '%s$$locals' % function_name
+    }
+    if count_instructions(loop) < count_instructions(unrolled):
+        return loop
+    return unrolled
+
+
+def report_prologues(prologue_sizes):
+    before, after = prologue_sizes
+    print('prologues: %d -> %d instructions (saved %d)' % (
+        before, after, before - after
+    ))
+
+
+def write_function(state, function_name, locals_count):
+    locals_count = int(locals_count)
+    if state.compact_locals:
+        prologue = compact_prologue(function_name, locals_count)
+        state.prologue_sizes[0] += (
+            locals_count * count_instructions(PUSH_ZERO)
+        )
+        state.prologue_sizes[1] += count_instructions(prologue)
+    else:
+        prologue = '\n'.join([PUSH_ZERO] * locals_count)
+    translated = FUNCTION % (
+        function_name, locals_count, function_name
+    ) + '\n' + prologue
+
+    state.current_function = function_name
     return translated
 
 
-def write_return():
-    global COUNT
-    translated = '\n'.join([
+def write_shared_return():
+    return '\n'.join([
         '// return',
+        '@$return',
+        '0;JMP'
+    ])
+
+
+def return_sequence():
+    return [
         # frame = LCL
         '@LCL',
         'D=M',
-        '@FRAME_%d' % COUNT,
+        '@R13',
         'M=D',
         # retAddr = *(frame-5)
-        'D=M',
         '@5',
         'A=D-A',
         'D=M',
-        '@RETADDR_%d' % COUNT,
+        '@R14',
         'M=D',
         # *ARG = pop
         '@SP',
@@ -412,227 +499,1352 @@ def write_return():
         '@SP',
         'M=D',
         # THAT = *(frame-1)
-        '@FRAME_%d' % COUNT,
-        'M=M-1',
-        'A=M',
+        '@R13',
+        'AM=M-1',
         'D=M',
         '@THAT',
         'M=D',
         # THIS = *(frame-2)
-        '@FRAME_%d' % COUNT,
-        'M=M-1',
-        'A=M',
+        '@R13',
+        'AM=M-1',
         'D=M',
         '@THIS',
         'M=D',
         # ARG = *(frame-3)
-        '@FRAME_%d' % COUNT,
-        'M=M-1',
-        'A=M',
+        '@R13',
+        'AM=M-1',
         'D=M',
         '@ARG',
         'M=D',
         # LCL = *(frame-4)
-        '@FRAME_%d' % COUNT,
-        'M=M-1',
-        'A=M',
+        '@R13',
+        'AM=M-1',
         'D=M',
         '@LCL',
         'M=D',
         # goto retAddr
-        '@RETADDR_%d' % COUNT,
+        '@R14',
         'A=M',
         '0;JMP'
+    ]
+
+
+# frame and return address live in R13/R14, so no per-site
+# variables are allocated in the static segment
+RETURN = '\n'.join(['// return'] + return_sequence())
+
+
+def write_return(state):
+    if state.shared_calls:
+        return write_shared_return()
+    return RETURN
+
+
+SHARED_CALL = '\n'.join([
+    '// call %(name)s %(args)s',
+    '@%(name)s',
+    'D=A',
+    '@R13',
+    'M=D',
+    '@%(args)s',
+    'D=A',
+    '@R14',
+    'M=D',
+    '@returnAddress%(count)s',
+    'D=A',
+    '@$call',
+    '0;JMP',
+    '(returnAddress%(count)s)'
+])
+
+
+def write_shared_call(state, function_name, args_count):
+    return SHARED_CALL % {
+        'name': function_name,
+        'args': args_count,
+        'count': next_label_id(state)
+    }
+
+
+def write_halt():
+    return '\n'.join([
+        '// halt, never fall through into the shared routines',
+        '($halt)',
+        '@$halt',
+        '0;JMP'
     ])
-    # FUNCTION_STACK.pop()
-    COUNT += 1
-    return translated
 
 
-def write_call(function_name, args_count):
-    global COUNT
-    translated = '\n'.join([
-        '// call %s %s' % (function_name, args_count),
-        '// push returnAddr',
-        '@%s' % ('returnAddress%d' % COUNT),
-        'D=A',
+def write_call_routines():
+    """
+    Single copy of the calling convention that every call site jumps to
+    with --shared-calls: $call expects the return address in D, the
+    callee in R13 and the argument count in R14
+    """
+    return '\n'.join([
+        '// shared call routine',
+        '($call)',
         '@SP',
         'A=M',
         'M=D',
-        '@SP',
-        'M=M+1',
-        '// push LCL',
         '@LCL',
         'D=M',
         '@SP',
-        'A=M',
+        'AM=M+1',
         'M=D',
-        '@SP',
-        'M=M+1',
-        '// push ARG',
         '@ARG',
         'D=M',
         '@SP',
-        'A=M',
+        'AM=M+1',
         'M=D',
-        '@SP',
-        'M=M+1',
-        '// push THIS',
         '@THIS',
         'D=M',
         '@SP',
-        'A=M',
+        'AM=M+1',
         'M=D',
-        '@SP',
-        'M=M+1',
-        '// push THAT',
         '@THAT',
         'D=M',
         '@SP',
-        'A=M',
+        'AM=M+1',
         'M=D',
+        '// LCL = SP',
         '@SP',
-        'M=M+1',
+        'MD=M+1',
+        '@LCL',
+        'M=D',
         '// ARG = SP - 5 - nArgs',
-        '@%d' % (5 + args_count),
-        'D=A',
-        '@SP',
-        'D=M-D',
+        '@R14',
+        'D=D-M',
+        '@5',
+        'D=D-A',
         '@ARG',
         'M=D',
-        '// LCL = SP',
-        '@SP',
+        '@R13',
+        'A=M',
+        '0;JMP',
+        '// shared return routine',
+        '($return)'
+    ] + return_sequence())
+
+
+CALL = '\n'.join([
+    '// call %(name)s %(args)s',
+    '// push returnAddr',
+    '@returnAddress%(count)s',
+    'D=A'
+] + PUSH_D + [
+    '// push LCL',
+    '@LCL',
+    'D=M'
+] + PUSH_D + [
+    '// push ARG',
+    '@ARG',
+    'D=M'
+] + PUSH_D + [
+    '// push THIS',
+    '@THIS',
+    'D=M'
+] + PUSH_D + [
+    '// push THAT',
+    '@THAT',
+    'D=M'
+] + PUSH_D + [
+    '// ARG = SP - 5 - nArgs',
+    '@%(offset)d',
+    'D=A',
+    '@SP',
+    'D=M-D',
+    '@ARG',
+    'M=D',
+    '// LCL = SP',
+    '@SP',
+    'D=M',
+    '@LCL',
+    'M=D',
+    '// goto function name',
+    '// goto',
+    '@%(name)s',
+    '0;JMP',
+    '(returnAddress%(count)s)'
+])
+
+
+def write_call(state, function_name, args_count):
+    args_count = int(args_count)
+    if state.shared_calls:
+        return write_shared_call(state, function_name, args_count)
+    return CALL % {
+        'name': function_name,
+        'args': args_count,
+        'offset': 5 + args_count,
+        'count': next_label_id(state)
+    }
+
+
+def remove_whitespace(line):
+    return line.split('//')[0].strip()
+
+
+# (command, segment) -> function translating the command's remaining
+# arguments for the FileTranslator passed first, segment is None for
+# everything but push and pop
+TRANSLATORS = {
+    ('push', 'constant'): push_constant,
+    ('push', 'temp'): push_temp,
+    ('push', 'pointer'): push_pointer,
+    ('push', 'static'): push_static,
+    ('pop', 'temp'): pop_temp,
+    ('pop', 'pointer'): pop_pointer,
+    ('pop', 'static'): pop_static,
+    ('add', None): add,
+    ('sub', None): sub,
+    ('neg', None): neg,
+    ('eq', None): eq,
+    ('gt', None): gt,
+    ('lt', None): lt,
+    ('and', None): bitwise_and,
+    ('or', None): bitwise_or,
+    ('not', None): bitwise_not,
+    ('label', None): write_label,
+    ('goto', None): goto,
+    ('if-goto', None): if_goto,
+    ('function', None): write_function,
+    ('call', None): write_call,
+    ('return', None): write_return
+}
+for segment in ('local', 'argument', 'this', 'that'):
+    TRANSLATORS['push', segment] = functools.partial(push, segment)
+    TRANSLATORS['pop', segment] = functools.partial(pop, segment)
+
+
+# top of the stack caching: push loads into D and leaves the value there,
+# the next command consumes it from D instead of RAM[SP - 1]
+SPILL = ['@SP', 'M=M+1', 'A=M-1', 'M=D']
+LOAD_TOS = ['@SP', 'AM=M-1', 'D=M']
+
+
+def tos_command(state, comment, code, tos_in, tos_out):
+    """
+    Command that expects the top of the stack in D when tos_in, in
+    memory otherwise, and leaves it in D when tos_out. D is spilled or
+    loaded first as needed, so the cached value survives only within a
+    run of commands that take it from D.
+    """
+    lines = [comment] if comment else []
+    if state.tos_in_d and not tos_in:
+        lines.extend(SPILL)
+    elif tos_in and not state.tos_in_d:
+        lines.extend(LOAD_TOS)
+    lines.append(code)
+    state.tos_in_d = tos_out
+    return '\n'.join(lines)
+
+
+def spill(state):
+    """
+    Store the cached top of the stack back to memory, at the end of a
+    file
+    """
+    state.tos_in_d = False
+    return '\n'.join(['// spill'] + SPILL)
+
+
+def spill_before(translator, state, *arguments):
+    # labels, gotos, calls, returns and function entries see the stack
+    # in memory, as on entry from any jump
+    return tos_command(
+        state, None, translator(state, *arguments), False, False
+    )
+
+
+def load_constant(state, i):
+    return tos_command(
+        state, '// push constant %s' % i, '@%s\nD=A' % i, False, True
+    )
+
+
+def load_temp(state, i):
+    return tos_command(state, '// push temp %s' % i, '@%d\nD=M' % (
+        MEMORY_SEGMENTS['temp'] + int(i)
+    ), False, True)
+
+
+def load_pointer(state, i):
+    return tos_command(state, '// push pointer %s' % i, '@%s\nD=M' % (
+        MEMORY_SEGMENTS[str(i)]
+    ), False, True)
+
+
+def load_static(state, i):
+    state.static_symbols.add('%s.%s' % (state.class_name, i))
+    return tos_command(state, '// push static %s' % i, '@%s.%s\nD=M' % (
+        state.class_name, i
+    ), False, True)
+
+
+def load_segment(segment, state, i):
+    if state.specialize_segments:
+        return tos_command(state, '// push %s %s' % (segment, i), '\n'.join(
+            segment_address(segment, int(i)) + ['D=M']
+        ), False, True)
+    return tos_command(state, '// push %s %s' % (segment, i), '\n'.join([
+        '@%s' % i,
+        'D=A',
+        '@%s' % MEMORY_SEGMENTS[segment],
+        'A=D+M',
+        'D=M'
+    ]), False, True)
+
+
+def store_temp(state, i):
+    return tos_command(state, '// pop temp %s' % i, '@%d\nM=D' % (
+        MEMORY_SEGMENTS['temp'] + int(i)
+    ), True, False)
+
+
+def store_pointer(state, i):
+    return tos_command(state, '// pop pointer %s' % i, '@%s\nM=D' % (
+        MEMORY_SEGMENTS[str(i)]
+    ), True, False)
+
+
+def store_static(state, i):
+    state.static_symbols.add('%s.%s' % (state.class_name, i))
+    return tos_command(state, '// pop static %s' % i, '@%s.%s\nM=D' % (
+        state.class_name, i
+    ), True, False)
+
+
+def store_segment(segment, state, i):
+    if state.specialize_segments and int(i) <= DIRECT_POP_LIMIT:
+        return tos_command(state, '// pop %s %s' % (segment, i), '\n'.join(
+            indexed_address(segment, int(i)) + ['M=D']
+        ), True, False)
+    return tos_command(state, '// pop %s %s' % (segment, i), '\n'.join([
+        '@R13',
+        'M=D',
+        '@%s' % MEMORY_SEGMENTS[segment],
         'D=M',
-        '@LCL',
+        '@%s' % i,
+        'D=D+A',
+        '@R14',
         'M=D',
-        '// goto function name',
-        '// goto',
-        '@%s' % function_name,
-        '0;JMP',
-        '(%s)' % ('returnAddress%d' % COUNT)
-    ])
-    COUNT += 1
-    # FUNCTION_STACK.append(function_name)
+        '@R13',
+        'D=M',
+        '@R14',
+        'A=M',
+        'M=D'
+    ]), True, False)
+
+
+def cached_binary_operation(command, operation):
+    # x op y with y in D and x popped from memory into D
+    def translate_cached(state):
+        return tos_command(
+            state, '// %s' % command, '@SP\nAM=M-1\nD=%s' % operation, True,
+            True
+        )
+    return translate_cached
+
+
+def cached_unary_operation(command, operation, translator):
+    def translate_cached(state):
+        if not state.tos_in_d:
+            return translator(state)
+        return '// %s\nD=%s' % (command, operation)
+    return translate_cached
+
+
+CACHED_COMPARE = '\n'.join([
+    '@SP',
+    'AM=M-1',
+    'D=M-D',
+    '@SET_TRUE_%(count)s',
+    'D;%(jump)s',
+    'D=0',
+    '@CONT_%(count)s',
+    '0;JMP',
+    '(SET_TRUE_%(count)s)',
+    'D=-1',
+    '(CONT_%(count)s)'
+])
+
+
+def cached_compare(command, state):
+    if state.shared_compare:
+        return spill_before(compare, state, command)
+    return tos_command(state, '// %s' % command, CACHED_COMPARE % {
+        'count': next_label_id(state),
+        'jump': COMPARE_JUMPS[command]
+    }, True, True)
+
+
+def cached_if_goto(state, label_name):
+    return tos_command(
+        state, '// if-goto',
+        '@%s\nD;JNE' % get_full_label_name(state, label_name), True, False
+    )
+
+
+# translators used with --cache-tos, everything not handled here spills
+CACHED_TRANSLATORS = {
+    key: functools.partial(spill_before, translator)
+    for key, translator in TRANSLATORS.items()
+}
+CACHED_TRANSLATORS.update({
+    ('push', 'constant'): load_constant,
+    ('push', 'temp'): load_temp,
+    ('push', 'pointer'): load_pointer,
+    ('push', 'static'): load_static,
+    ('pop', 'temp'): store_temp,
+    ('pop', 'pointer'): store_pointer,
+    ('pop', 'static'): store_static,
+    ('add', None): cached_binary_operation('add', 'D+M'),
+    ('sub', None): cached_binary_operation('sub', 'M-D'),
+    ('and', None): cached_binary_operation('and', 'D&M'),
+    ('or', None): cached_binary_operation('or', 'D|M'),
+    ('neg', None): cached_unary_operation('neg', '-D', neg),
+    ('not', None): cached_unary_operation('not', '!D', bitwise_not),
+    ('eq', None): functools.partial(cached_compare, 'eq'),
+    ('gt', None): functools.partial(cached_compare, 'gt'),
+    ('lt', None): functools.partial(cached_compare, 'lt'),
+    ('if-goto', None): cached_if_goto
+})
+for segment in ('local', 'argument', 'this', 'that'):
+    CACHED_TRANSLATORS['push', segment] = functools.partial(
+        load_segment, segment
+    )
+    CACHED_TRANSLATORS['pop', segment] = functools.partial(
+        store_segment, segment
+    )
+
+
+def find_translator(translators, command, arg1=None, arg2=None):
+    """
+    (key, translator, arguments) for a command split up into words or
+    into a ('push', 'constant', 7) tuple as read_bytecode() returns
+    """
+    if command in ('push', 'pop') and arg2 is not None:
+        key, arguments = (command, arg1), (arg2,)
+    else:
+        key = (command, None)
+        arguments = [arg for arg in (arg1, arg2) if arg is not None]
+    try:
+        return key, translators[key], arguments
+    except KeyError:
+        raise NotImplementedError(' '.join(
+            str(word) for word in (command, arg1, arg2) if word is not None
+        ))
+
+
+def translate_command(state, command, arg1=None, arg2=None):
+    translators = CACHED_TRANSLATORS if state.cache_tos else TRANSLATORS
+    _, translator, arguments = find_translator(
+        translators, command, arg1, arg2
+    )
+    return translator(state, *arguments)
+
+
+# commands whose translation depends on nothing but their text
+PURE_COMMANDS = frozenset(
+    key for key in TRANSLATORS
+    if key[1] not in (None, 'static') or key[0] in (
+        'add', 'sub', 'neg', 'and', 'or', 'not'
+    )
+)
+# most lines a FileTranslator remembers the translation of
+MEMO_SIZE = 1024
+
+
+def translate(state, line):
+    """
+    Translate a line of a .vm file, remembering the translations of
+    pure commands for the rest of the file. Not used with --cache-tos
+    where the translation also depends on the commands before.
+    """
+    if state.cache_tos:
+        return translate_command(state, *line.split())
+    translated = state.memo.get(line)
+    if translated is not None:
+        return translated
+    key, translator, arguments = find_translator(TRANSLATORS, *line.split())
+    translated = translator(state, *arguments)
+    if key in PURE_COMMANDS and len(state.memo) < MEMO_SIZE:
+        state.memo[line] = translated
     return translated
 
 
-def remove_whitespace(line):
-    if line.startswith('call') or line.startswith('function'):
-        return line.split('//')[0].strip()
-    return line.replace(' ', '').split('//')[0].strip()
-
-
-def translate(line):
-    if line.startswith('pushconstant'):
-        i = line.lstrip('pushconstant')
-        return push_constant(i)
-    elif line.startswith('pushtemp'):
-        i = line.lstrip('pushtemp')
-        return push_temp(i)
-    elif line.startswith('pushpointer'):
-        i = line.lstrip('pushpointer')
-        return push_pointer(i)
-    elif line.startswith('pushstatic'):
-        i = line.lstrip('pushstatic')
-        return push_static(i)
-    elif line.startswith('push'):
-        segment, i = re.match(
-            r'^push([a-zA-Z]+)(\d+)$',
-            line
-        ).groups()
-        return push(segment, i)
-    elif line.startswith('poptemp'):
-        i = line.lstrip('poptemp')
-        return pop_temp(i)
-    elif line.startswith('poppointer'):
-        i = line.lstrip('poppointer')
-        return pop_pointer(i)
-    elif line.startswith('popstatic'):
-        i = line.lstrip('popstatic')
-        return pop_static(i)
-    elif line.startswith('pop'):
-        segment, i = re.match(
-            r'^pop([a-zA-Z]+)(\d+)$',
-            line
-        ).groups()
-        return pop(segment, i)
-    elif line == 'add':
-        return add()
-    elif line == 'eq':
-        return eq()
-    elif line == 'lt':
-        return lt()
-    elif line == 'gt':
-        return gt()
-    elif line == 'sub':
-        return sub()
-    elif line == 'not':
-        return bitwise_not()
-    elif line == 'and':
-        return bitwise_and()
-    elif line == 'or':
-        return bitwise_or()
-    elif line == 'neg':
-        return neg()
-    elif line.startswith('label'):
-        label_name = line.lstrip('label')
-        return write_label(label_name)
-    elif line.startswith('if-goto'):
-        label_name = line.lstrip('if-goto')
-        return if_goto(label_name)
-    elif line.startswith('goto'):
-        label_name = line.lstrip('goto')
-        return goto(label_name)
-    elif line.startswith('function'):
-        function_name, locals_count = re.match(
-            r'^function ([a-zA-Z\.\d]+) ?(\d*)$',
-            line
-        ).groups()
-        return write_function(
-            function_name,
-            int(locals_count)
+# super-instructions: runs of commands the Jack compiler emits over and
+# over, each translated as a whole into a shorter sequence
+
+NEGATED_JUMPS = {
+    'JEQ': 'JNE',
+    'JLT': 'JGE',
+    'JGT': 'JLE'
+}
+
+ARRAY_READ = '\n'.join([
+    '// pop pointer 1 / push that 0',
+    '@SP',
+    'A=M-1',
+    'D=M',
+    '@THAT',
+    'M=D',
+    'A=D',
+    'D=M',
+    '@SP',
+    'A=M-1',
+    'M=D'
+])
+
+ARRAY_WRITE = '\n'.join([
+    '// pop temp 0 / pop pointer 1 / push temp 0 / pop that 0',
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    '@5',
+    'M=D',
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    '@THAT',
+    'M=D',
+    '@5',
+    'D=M',
+    '@THAT',
+    'A=M',
+    'M=D'
+])
+
+PUSH_TRUE = '\n'.join([
+    '// push constant 0 / not',
+    '@SP',
+    'M=M+1',
+    'A=M-1',
+    'M=-1'
+])
+
+DOUBLE_NOT = '// not / not'
+
+# ~x is non-zero, and the branch taken, for every x but -1
+NOT_BRANCH = '\n'.join([
+    '// not / if-goto %s',
+    '@SP',
+    'AM=M-1',
+    'D=M+1',
+    '@%s',
+    'D;JNE'
+])
+
+COMPARE_BRANCH = '\n'.join([
+    '// %(commands)s',
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    'A=A-1',
+    'D=M-D',
+    '@SP',
+    'M=M-1',
+    '@%(label)s',
+    'D;%(jump)s'
+])
+
+
+def fused_array_read(state):
+    return ARRAY_READ
+
+
+def fused_array_write(state):
+    return ARRAY_WRITE
+
+
+def fused_true(state):
+    return PUSH_TRUE
+
+
+def fused_double_not(state):
+    return DOUBLE_NOT
+
+
+def fused_not_branch(state, label_name):
+    label = get_full_label_name(state, label_name)
+    return NOT_BRANCH % (label_name, label)
+
+
+def fused_compare_branch(state, command, negated, label_name):
+    jump = COMPARE_JUMPS[command]
+    commands = [command]
+    if negated:
+        jump = NEGATED_JUMPS[jump]
+        commands.append('not')
+    return COMPARE_BRANCH % {
+        'commands': ' / '.join(commands + ['if-goto %s' % label_name]),
+        'label': get_full_label_name(state, label_name),
+        'jump': jump
+    }
+
+
+def fused_compare_not(state, command):
+    return COMPARE % {
+        'command': '%s / not' % command,
+        'count': next_label_id(state),
+        'jump': NEGATED_JUMPS[COMPARE_JUMPS[command]]
+    }
+
+
+def fused_add_constant(state, operation, constant):
+    sign = '+' if operation == 'add' else '-'
+    lines = ['// push constant %s / %s' % (constant, operation)]
+    if constant == 1:
+        lines.extend(['@SP', 'A=M-1', 'M=M%s1' % sign])
+    else:
+        lines.extend(['@%s' % constant, 'D=A', '@SP', 'A=M-1',
+                      'M=M%sD' % sign])
+    return '\n'.join(lines)
+
+
+def fused_increment(state, operation, segment, i, constant):
+    sign = '+' if operation == 'add' else '-'
+    lines = ['// push %s %s / push constant %s / %s / pop %s %s' % (
+        segment, i, constant, operation, segment, i
+    )]
+    if segment in ('local', 'argument', 'this', 'that'):
+        base = MEMORY_SEGMENTS[segment]
+        if constant != 1:
+            lines.extend(['@%s' % base, 'D=M', '@%s' % i, 'D=D+A', '@R13',
+                          'M=D', '@%s' % constant, 'D=A', '@R13', 'A=M'])
+        elif i == 0:
+            lines.extend(['@%s' % base, 'A=M'])
+        else:
+            lines.extend(['@%s' % i, 'D=A', '@%s' % base, 'A=D+M'])
+    else:
+        if segment == 'static':
+            address = '%s.%s' % (state.class_name, i)
+            state.static_symbols.add(address)
+        elif segment == 'temp':
+            address = MEMORY_SEGMENTS['temp'] + i
+        else:
+            address = MEMORY_SEGMENTS[str(i)]
+        if constant != 1:
+            lines.extend(['@%s' % constant, 'D=A'])
+        lines.append('@%s' % address)
+    lines.append('M=M%s%s' % (sign, 1 if constant == 1 else 'D'))
+    return '\n'.join(lines)
+
+
+def fused_return_zero(state):
+    # the return sequence storing 0 as the return value instead of the
+    # top of the stack
+    sequence = return_sequence()
+    store = ['@SP', 'A=M-1', 'D=M', '@ARG', 'A=M', 'M=D']
+    for index in range(len(sequence)):
+        if sequence[index:index + len(store)] == store:
+            sequence[index:index + len(store)] = ['@ARG', 'A=M', 'M=0']
+            break
+    return '\n'.join(['// push constant 0 / return'] + sequence)
+
+
+def fixed_idiom(*commands):
+    commands = list(commands)
+
+    def match(state, window):
+        if window[:len(commands)] == commands:
+            return len(commands), ()
+    return match
+
+
+def match_compare_branch(state, window):
+    if window[0][0] not in COMPARE_JUMPS:
+        return None
+    negated = window[1:2] == [('not', None, None)]
+    branch = window[1 + negated:2 + negated]
+    if branch and branch[0][0] == 'if-goto':
+        return 2 + negated, (window[0][0], negated, branch[0][1])
+
+
+def match_compare_not(state, window):
+    # the inline comparison is far longer than a jump into the shared one
+    if state.shared_compare:
+        return None
+    if window[0][0] in COMPARE_JUMPS and window[1:2] == [('not', None, None)]:
+        return 2, (window[0][0],)
+
+
+def match_not_branch(state, window):
+    if window[0] == ('not', None, None) and window[1:2] and (
+        window[1][0] == 'if-goto'
+    ):
+        return 2, (window[1][1],)
+
+
+def match_add_constant(state, window):
+    if window[0][:2] == ('push', 'constant') and window[1:2] and (
+        window[1][0] in ('add', 'sub')
+    ):
+        return 2, (window[1][0], window[0][2])
+
+
+def match_increment(state, window):
+    if len(window) < 4:
+        return None
+    push, constant, operation, pop = window[:4]
+    if (
+        push[0] == 'push' and push[1] != 'constant' and
+        constant[:2] == ('push', 'constant') and
+        operation[0] in ('add', 'sub') and pop == ('pop',) + push[1:]
+    ):
+        return 4, (operation[0], push[1], push[2], constant[2])
+
+
+def match_return_zero(state, window):
+    if not state.shared_calls and window[:2] == [
+        ('push', 'constant', 0), ('return', None, None)
+    ]:
+        return 2, ()
+
+
+# (name, match, translator) tried in order at every command, match
+# gets the FileTranslator and the commands from there on and returns
+# the number of commands fused and the translator's arguments
+IDIOMS = (
+    ('array read', fixed_idiom(
+        ('pop', 'pointer', 1), ('push', 'that', 0)
+    ), fused_array_read),
+    ('array write', fixed_idiom(
+        ('pop', 'temp', 0), ('pop', 'pointer', 1), ('push', 'temp', 0),
+        ('pop', 'that', 0)
+    ), fused_array_write),
+    ('compare and branch', match_compare_branch, fused_compare_branch),
+    ('negated compare', match_compare_not, fused_compare_not),
+    ('double not', fixed_idiom(
+        ('not', None, None), ('not', None, None)
+    ), fused_double_not),
+    ('branch if false', match_not_branch, fused_not_branch),
+    ('true', fixed_idiom(
+        ('push', 'constant', 0), ('not', None, None)
+    ), fused_true),
+    ('return 0', match_return_zero, fused_return_zero),
+    ('increment', match_increment, fused_increment),
+    ('add constant', match_add_constant, fused_add_constant)
+)
+# the longest idiom, how many commands match() gets to look at
+IDIOM_WINDOW = 4
+
+
+# templates measured in place of the translators that use up label ids
+# or record statics
+UNFUSED_TEMPLATES = {
+    ('push', 'static'): PUSH_STATIC,
+    ('pop', 'static'): POP_STATIC
+}
+
+
+def unfused_size(state, commands):
+    """
+    Instructions the commands take translated one by one, measured
+    without side effects on the label ids or statics of the output
+    """
+    size = 0
+    for command, arg1, arg2 in commands:
+        if command in COMPARE_JUMPS:
+            translated = (
+                SHARED_COMPARE_CALL if state.shared_compare else COMPARE
+            )
+        elif (command, arg1) in UNFUSED_TEMPLATES:
+            translated = UNFUSED_TEMPLATES[command, arg1]
+        else:
+            _, translator, arguments = find_translator(
+                TRANSLATORS, command, arg1, arg2
+            )
+            translated = translator(state, *arguments)
+        size += count_instructions(translated)
+    return size
+
+
+def fuse_idiom(state, window):
+    """
+    (name, number of commands fused, translated, instructions saved) for
+    the first of the IDIOMS at the start of window that is no longer than
+    the plain translation of its commands, None when there is none
+    """
+    for name, match, translator in IDIOMS:
+        matched = match(state, window)
+        if not matched:
+            continue
+        length, arguments = matched
+        count = state.count
+        translated = translator(state, *arguments)
+        saved = (
+            unfused_size(state, window[:length]) -
+            count_instructions(translated)
         )
-    elif line == ('return'):
-        return write_return()
-    elif line.startswith('call'):
-        function_name, args_count = re.match(
-            r'^call ([a-zA-Z\.\d]+) ?(\d*)$',
-            line
-        ).groups()
-        return write_call(
+        if saved >= 0:
+            return name, length, translated, saved
+        # refused, give back the label ids it took
+        state.count = count
+    return None
+
+
+def translate_fused(state, commands):
+    """
+    (command or idiom name, translated) for a list of (command, arg1,
+    arg2) tuples, fusing the IDIOMS found among them
+    """
+    index = 0
+    while index < len(commands):
+        window = commands[index:index + IDIOM_WINDOW]
+        fused = fuse_idiom(state, window)
+        if fused is None:
+            yield window[0][0], translate_command(state, *window[0])
+            index += 1
+            continue
+        name, length, translated, saved = fused
+        counts = state.idiom_counts.setdefault(name, [0, 0])
+        counts[0] += 1
+        counts[1] += saved
+        if state.cache_tos:
+            translated = tos_command(state, None, translated, False, False)
+        yield name, translated
+        index += length
+
+
+def report_idioms(idiom_counts):
+    for name, (fired, saved) in sorted(
+        idiom_counts.items(), key=lambda item: -item[1][1]
+    ):
+        print('%s: fired %d times, saved %d instructions' % (
+            name, fired, saved
+        ))
+    print('idioms: saved %d instructions' % sum(
+        saved for _, saved in idiom_counts.values()
+    ))
+
+
+def read_bytecode(f):
+    """
+    Decode a .vmb file, read in one go, into (command, arg1, arg2)
+    tuples with names looked up in its string table
+    """
+    data = f.read()
+    if data[:4] != BYTECODE_MAGIC:
+        raise ValueError('%s is not a VM bytecode file' % f.name)
+    string_count, = struct.unpack_from('<H', data, 4)
+    offset = 6
+    strings = []
+    for _ in range(string_count):
+        length, = BYTECODE_STRING_LENGTH.unpack_from(data, offset)
+        offset += BYTECODE_STRING_LENGTH.size
+        strings.append(data[offset:offset + length].decode('ascii'))
+        offset += length
+    commands = []
+    for opcode, segment, operand in BYTECODE_RECORD.iter_unpack(
+        memoryview(data)[offset:]
+    ):
+        command = BYTECODE_COMMANDS[opcode]
+        if command in ('push', 'pop'):
+            commands.append((command, BYTECODE_SEGMENTS[segment], operand))
+        elif command in BYTECODE_NAMED:
+            commands.append((
+                command, strings[operand],
+                segment if command in ('function', 'call') else None
+            ))
+        else:
+            commands.append((command, None, None))
+    return commands
+
+
+def read_commands(filename):
+    """
+    (command, arg1, arg2) tuples of a .vm or .vmb file, arg2 as an int
+    """
+    if filename.endswith('.vmb'):
+        with open(filename, 'rb') as f:
+            return read_bytecode(f)
+    commands = []
+    with open(filename) as f:
+        for line in f:
+            words = remove_whitespace(line).split()
+            if words:
+                commands.append((
+                    words[0],
+                    words[1] if len(words) > 1 else None,
+                    int(words[2]) if len(words) > 2 else None
+                ))
+    return commands
+
+
+def translate_commands(state, commands):
+    """
+    (command, translated) for each of a list of (command, arg1, arg2)
+    tuples, with --fuse the name of an idiom in place of its commands
+    """
+    if state.fuse:
+        yield from translate_fused(state, commands)
+        return
+    for command, arg1, arg2 in commands:
+        yield command, translate_command(state, command, arg1, arg2)
+
+
+def translate_file(state, filename):
+    """
+    (command, translated) for each command of a .vm or .vmb file
+    """
+    if state.fuse or filename.endswith('.vmb'):
+        yield from translate_commands(state, read_commands(filename))
+        return
+    with open(filename) as f:
+        for line in f:
+            parsed_line = remove_whitespace(line)
+            if parsed_line:
+                yield parsed_line.split()[0], translate(state, parsed_line)
+
+
+def call_graph(file_commands):
+    """
+    function -> [number of commands, set of functions it calls] for the
+    commands of every file, in order of definition
+    """
+    graph = {}
+    for commands in file_commands.values():
+        current = None
+        for command, arg1, _ in commands:
+            if command == 'function':
+                current = graph[arg1] = [0, set()]
+            elif command == 'call' and current is not None:
+                current[1].add(arg1)
+            if current is not None:
+                current[0] += 1
+    return graph
+
+
+def reachable_functions(graph, entry):
+    reachable = {entry}
+    pending = [entry]
+    while pending:
+        for callee in graph[pending.pop()][1]:
+            # calls into functions no file defines stay as they are
+            if callee in graph and callee not in reachable:
+                reachable.add(callee)
+                pending.append(callee)
+    return reachable
+
+
+def remove_unreachable(file_list, entry='Sys.init'):
+    """
+    The commands of each file without the functions that no chain of
+    calls from entry reaches, None when no file defines entry. Prints
+    which functions were kept and which removed.
+    """
+    file_commands = {
+        filename: read_commands(filename) for filename in file_list
+    }
+    graph = call_graph(file_commands)
+    if entry not in graph:
+        return None
+    reachable = reachable_functions(graph, entry)
+    for function_name, (size, _) in graph.items():
+        print('%s: %s (%d commands)' % (
             function_name,
-            int(args_count)
+            'kept' if function_name in reachable else 'removed', size
+        ))
+    print('functions: kept %d, removed %d (%d commands)' % (
+        len(reachable), len(graph) - len(reachable), sum(
+            size for function_name, (size, _) in graph.items()
+            if function_name not in reachable
         )
-
-    raise NotImplementedError(line)
+    ))
+    for filename, commands in file_commands.items():
+        kept = []
+        keep = True
+        for command in commands:
+            if command[0] == 'function':
+                keep = command[1] in reachable
+            if keep:
+                kept.append(command)
+        file_commands[filename] = kept
+    return file_commands
+
+
+def count_instructions(translated):
+    return sum(
+        1 for line in translated.split('\n')
+        if line and not line.startswith('//') and not line.startswith('(')
+    )
 
 
-if IS_DIR:
-    dir_name = path.rstrip('/').split('/')[-1]
-    new_file = open(path + dir_name + '.asm', 'w')
-    new_file.write(
-        '\n'.join([
+def get_file_list(path):
+    """
+    .vm and .vmb files of a directory, when a class has both the one
+    written last is used
+    """
+    file_list = []
+    if not os.path.isdir(path):
+        file_list.append(path)
+    else:
+        classes = {}
+        for filename in os.listdir(path):
+            class_name, extension = os.path.splitext(filename)
+            if extension in ('.vm', '.vmb'):
+                path_to_file = os.path.join(path, filename)
+                newest = classes.get(class_name)
+                if newest is None or (
+                    os.path.getmtime(path_to_file) > os.path.getmtime(newest)
+                ):
+                    classes[class_name] = path_to_file
+        file_list.extend(classes.values())
+    return file_list
+
+
+def get_class_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def get_output_path(path):
+    if os.path.isdir(path):
+        if not path.endswith('/'):
+            path = path + '/'
+        dir_name = path.rstrip('/').split('/')[-1]
+        return path + dir_name + '.asm'
+    return os.path.splitext(path)[0] + '.asm'
+
+
+def report_shared_routines(rom_size, calls, returns, comparisons,
+                           shared_calls, shared_compare):
+    # sizes do not depend on the operands, translate one of each with
+    # and without the shared routines to measure
+    shared = FileTranslator('$measure', {
+        'shared_calls': True,
+        'shared_compare': True
+    })
+    inline = FileTranslator('$measure', {})
+
+    saved = -count_instructions(write_halt())
+    if shared_calls:
+        saved_calls = (
+            calls * (
+                count_instructions(write_call(inline, 'f', 0)) -
+                count_instructions(write_call(shared, 'f', 0))
+            ) + returns * (
+                count_instructions(write_return(inline)) -
+                count_instructions(write_return(shared))
+            ) - count_instructions(write_call_routines())
+        )
+        saved += saved_calls
+        print('calls: %d calls, %d returns, saved %d instructions' % (
+            calls, returns, saved_calls
+        ))
+    if shared_compare:
+        saved_compare = sum(comparisons.values()) * (
+            count_instructions(eq(inline)) - count_instructions(eq(shared))
+        ) - sum(
+            count_instructions(write_compare_routine(command))
+            for command in comparisons
+        )
+        saved += saved_compare
+        print('comparisons: %d comparisons, saved %d instructions' % (
+            sum(comparisons.values()), saved_compare
+        ))
+    print('ROM: %d instructions, %d inline (saved %d)' % (
+        rom_size, rom_size + saved, saved
+    ))
+
+
+def report_static_usage(static_symbols, verbose=False):
+    """
+    Print static cells used per class and fail when the statics no
+    longer fit in RAM[16..255]
+    """
+    per_class = {}
+    for symbol in static_symbols:
+        class_name = symbol.rsplit('.', 1)[0]
+        per_class[class_name] = per_class.get(class_name, 0) + 1
+    overflow = len(static_symbols) > STATIC_SEGMENT_SIZE
+    if verbose or overflow:
+        for class_name in sorted(per_class):
+            print('%s: %d static' % (class_name, per_class[class_name]))
+        print('static: %d of %d cells used' % (
+            len(static_symbols), STATIC_SEGMENT_SIZE
+        ))
+    return not overflow
+
+
+def optimize_output(output, functions):
+    """
+    Run the peephole optimizer over the code of each function on its
+    own, printing the instruction counts before and after. functions
+    holds (name, index of its first chunk in output) pairs.
+    """
+    optimized = []
+    total_before = total_after = 0
+    ends = [start for _, start in functions[1:]] + [len(output)]
+    for (name, start), end in zip(functions, ends):
+        instructions = [
+            line for line in ''.join(output[start:end]).split('\n')
+            if line and not line.startswith('//')
+        ]
+        if not instructions:
+            continue
+        before = peephole.count_instructions(instructions)
+        instructions = peephole.optimize(instructions)
+        after = peephole.count_instructions(instructions)
+        print('%s: %d -> %d instructions' % (name, before, after))
+        total_before += before
+        total_after += after
+        optimized.append('\n'.join(instructions) + '\n')
+    print('peephole: %d -> %d instructions (saved %d)' % (
+        total_before, total_after, total_before - total_after
+    ))
+    return optimized
+
+
+class FileTranslator(object):
+    """
+    Translation of a single .vm/.vmb file together with the state the
+    command translators keep while it runs, each of them gets this
+    object first. Its labels are namespaced by the class name and
+    numbered from 0, so the result depends neither on the other files
+    nor on the order they are translated in, which lets any worker
+    process translate any file.
+    """
+    def __init__(self, filename, options, commands=None):
+        self.filename = filename
+        self.class_name = get_class_name(filename)
+        # emit calls/returns as jumps into shared $call/$return routines
+        self.shared_calls = options.get('shared_calls', False)
+        # emit eq/lt/gt as jumps into shared $eq/$lt/$gt routines
+        self.shared_compare = options.get('shared_compare', False)
+        # keep the top of the stack in D between commands, see
+        # tos_command()
+        self.cache_tos = options.get('cache_tos', False)
+        # translate the runs of commands in IDIOMS as a whole
+        self.fuse = options.get('fuse', False)
+        # address local/argument/this/that entries with index-specialized
+        # code, see segment_address()
+        self.specialize_segments = options.get('specialize_segments', False)
+        # zero the locals of a function with compact_prologue() instead
+        # of one push constant 0 per local
+        self.compact_locals = options.get('compact_locals', False)
+        # (command, arg1, arg2) tuples to translate instead of the file
+        self.commands = commands
+        # line -> translation of the pure commands seen so far, see
+        # translate()
+        self.memo = {}
+        # number of the next generated label, see next_label_id()
+        self.count = 0
+        self.current_function = None
+        # whether D holds the top of the stack at this point of the
+        # output, RAM[0] then counts only the entries below it
+        self.tos_in_d = False
+        # (command or idiom name, translated) pairs
+        self.translated = []
+        # index in translated -> name of the function starting there
+        self.functions = {}
+        # static variables referenced, each of them takes a cell in
+        # RAM[16..255]
+        self.static_symbols = set()
+        # idiom name -> [times fired, instructions saved]
+        self.idiom_counts = {}
+        # [instructions as pushes, instructions emitted] over the
+        # prologues translated with compact_locals
+        self.prologue_sizes = [0, 0]
+
+    def translate(self):
+        if self.commands is not None:
+            translations = translate_commands(self, self.commands)
+        else:
+            translations = translate_file(self, self.filename)
+        for command, translated in translations:
+            if command == 'function':
+                self.functions[len(self.translated)] = self.current_function
+            self.translated.append((command, translated))
+        if self.tos_in_d:
+            self.translated.append(('spill', spill(self)))
+        return self
+
+
+def translate_job(translator):
+    return translator.translate()
+
+
+def translate_files(translators, jobs=1):
+    """
+    Run the translators in a pool of jobs worker processes, results come
+    back in the order they were given
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(translate_job, translators))
+    return [translator.translate() for translator in translators]
+
+
+def main(path, shared_calls=False, shared_compare=False,
+         static_report=False, optimize=False, cache_tos=False, fuse=False,
+         specialize_segments=False, compact_locals=False,
+         remove_dead=False, jobs=1):
+    options = {
+        'shared_calls': shared_calls,
+        'shared_compare': shared_compare,
+        'cache_tos': cache_tos,
+        'fuse': fuse,
+        'specialize_segments': specialize_segments,
+        'compact_locals': compact_locals
+    }
+    # sorted, so that the output does not depend on os.listdir() order
+    file_list = sorted(get_file_list(path))
+    output_path = get_output_path(path)
+    if os.path.isdir(path):
+        # a $ cannot appear in a class name, so neither in its labels
+        bootstrap = '\n'.join([
             '@256',
             'D=A',
             '@SP',
             'M=D',
             write_call(
+                FileTranslator('$bootstrap', options),
                 'Sys.init',
                 0
             )
         ]) + '\n'
+    else:
+        bootstrap = ''
+    # translated chunks, written out in one go once the shared routines
+    # are known, and where each function starts among them
+    output = [bootstrap]
+    functions = [('(bootstrap)' if bootstrap else '(top level)', 0)]
+    rom_size = count_instructions(bootstrap)
+    calls = returns = 0
+    comparisons = {}
+    static_symbols = set()
+    idiom_counts = {}
+    prologue_sizes = [0, 0]
+
+    # only a whole program has a Sys.init to start the call graph from
+    file_commands = None
+    if remove_dead and bootstrap:
+        file_commands = remove_unreachable(file_list)
+
+    translators = translate_files([
+        FileTranslator(
+            filename, options,
+            file_commands[filename] if file_commands is not None else None
+        )
+        for filename in file_list
+    ], jobs)
+    for translator in translators:
+        static_symbols.update(translator.static_symbols)
+        for name, (fired, saved) in translator.idiom_counts.items():
+            counts = idiom_counts.setdefault(name, [0, 0])
+            counts[0] += fired
+            counts[1] += saved
+        prologue_sizes[0] += translator.prologue_sizes[0]
+        prologue_sizes[1] += translator.prologue_sizes[1]
+
+        for index, (command, translated_line) in enumerate(
+            translator.translated
+        ):
+            if index in translator.functions:
+                functions.append((translator.functions[index], len(output)))
+            output.append(translated_line + '\n')
+            rom_size += count_instructions(translated_line)
+            if command == 'call':
+                calls += 1
+            elif command == 'return':
+                returns += 1
+            elif command in COMPARE_JUMPS:
+                comparisons[command] = comparisons.get(command, 0) + 1
+
+    calls += bool(bootstrap)
+    shared_calls = shared_calls and bool(calls or returns)
+    shared_compare = shared_compare and bool(comparisons)
+    routines = []
+    if shared_calls:
+        routines.append(write_call_routines())
+    if shared_compare:
+        routines.extend(
+            write_compare_routine(command) for command in sorted(comparisons)
+        )
+    if routines:
+        routines = '\n'.join([write_halt()] + routines)
+        functions.append(('(shared routines)', len(output)))
+        output.append(routines + '\n')
+        rom_size += count_instructions(routines)
+        report_shared_routines(
+            rom_size, calls, returns, comparisons, shared_calls,
+            shared_compare
+        )
+    if fuse:
+        report_idioms(idiom_counts)
+    if compact_locals:
+        report_prologues(prologue_sizes)
+    if optimize:
+        output = optimize_output(output, functions)
+    with open(output_path, 'w') as new_file:
+        new_file.write(''.join(output))
+    if not report_static_usage(static_symbols, static_report):
+        os.remove(output_path)
+        sys.exit('static segment overflow: %d variables do not fit in '
+                 'RAM[16..255]' % len(static_symbols))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'path', help='.vm/.vmb file or directory of .vm/.vmb files'
+    )
+    parser.add_argument(
+        '--shared-calls', action='store_true',
+        help='jump into one shared call/return routine instead of '
+             'inlining the calling convention at every site'
+    )
+    parser.add_argument(
+        '--shared-compare', action='store_true',
+        help='jump into one shared routine per eq/lt/gt instead of '
+             'inlining the comparison at every site'
+    )
+    parser.add_argument(
+        '--static-report', action='store_true',
+        help='print how many static cells each class uses'
+    )
+    parser.add_argument(
+        '--peephole', action='store_true',
+        help='optimize the translated assembly and print instruction '
+             'counts before and after for each function'
+    )
+    parser.add_argument(
+        '--cache-tos', action='store_true',
+        help='keep the top of the stack in D between commands, storing it '
+             'only at labels, calls and returns'
+    )
+    parser.add_argument(
+        '--fuse', action='store_true',
+        help='translate common runs of commands, such as array reads and '
+             'counter increments, as single shorter sequences and print '
+             'how often each fired'
+    )
+    parser.add_argument(
+        '--specialize-segments', action='store_true',
+        help='address local/argument/this/that entries with code '
+             'specialized for small indexes'
+    )
+    parser.add_argument(
+        '--compact-locals', action='store_true',
+        help='zero the locals of a function with direct stores or a loop, '
+             'whichever is smaller, and print the prologue sizes before '
+             'and after'
+    )
+    parser.add_argument(
+        '--remove-dead', action='store_true',
+        help='leave out the functions no chain of calls from Sys.init '
+             'reaches and print which functions were kept'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='number of worker processes translating files in parallel'
+    )
+    args = parser.parse_args()
+    main(
+        args.path, args.shared_calls, args.shared_compare,
+        args.static_report, args.peephole, args.cache_tos, args.fuse,
+        args.specialize_segments, args.compact_locals, args.remove_dead,
+        args.jobs
     )
-else:
-    new_file = open(path.rstrip('.vm') + '.asm', 'w')
-
-for filename in FILE_LIST:
-    opened_file = open(filename)
-    CLASS_NAME = opened_file.name.split('/')[-1].rstrip('.vm')
-
-    for line in opened_file:
-        parsed_line = remove_whitespace(line)
-        if parsed_line:
-            translated_line = translate(parsed_line)
-            new_file.write(translated_line + '\n')
-
-new_file.close()
@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import VMTranslator
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'project_6'
+))
+import assembler  # noqa: E402
+import emulator  # noqa: E402
+
+# registers used by the project 7 tests, overwritten by the bootstrap
+# code when a whole directory is translated
+INITIAL_RAM = {
+    0: 256,
+    1: 300,
+    2: 400,
+    3: 3000,
+    4: 3010
+}
+
+
+def measure(path, args, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        VMTranslator.main(path, **options)
+    with open(VMTranslator.get_output_path(path)) as f:
+        rom = assembler.assemble(f)
+    cpu = emulator.HackEmulator(rom)
+    for address, value in INITIAL_RAM.items():
+        cpu.ram[address] = value
+    cycles = cpu.run(args.cycles, args.stop)
+    return len(rom), cycles
+
+
+def bench_modes(args, modes):
+    print('%-24s %-10s %8s %10s' % ('program', 'mode', 'rom', 'cycles'))
+    for path in args.paths:
+        name = os.path.basename(path.rstrip('/'))
+        for mode, options in modes:
+            rom_size, cycles = measure(path, args, **options)
+            print('%-24s %-10s %8d %10d' % (name, mode, rom_size, cycles))
+
+
+def bench_compare(args):
+    bench_modes(args, [
+        ('inline', {}),
+        ('shared', {'shared_compare': True})
+    ])
+
+
+def bench_tos(args):
+    """
+    Executed cycles with the stack entirely in memory against the top
+    of the stack cached in D, with --shared-calls for programs whose
+    inline translation does not fit in ROM
+    """
+    shared = {'shared_calls': args.shared_calls}
+    bench_modes(args, [
+        ('stack', shared),
+        ('cached', dict(shared, cache_tos=True))
+    ])
+
+
+def bench_segments(args):
+    """
+    ROM and executed cycles with the generic local/argument/this/that
+    templates against the index-specialized ones
+    """
+    shared = {'shared_calls': args.shared_calls}
+    bench_modes(args, [
+        ('generic', shared),
+        ('indexed', dict(shared, specialize_segments=True))
+    ])
+
+
+def generate_input(paths, size):
+    """
+    (class name, lines) of the .vm files under `paths`, repeated to at
+    least `size` bytes
+    """
+    files = []
+    for path in paths:
+        for filename in sorted(VMTranslator.get_file_list(path)):
+            if filename.endswith('.vm'):
+                with open(filename) as f:
+                    files.append((filename, f.readlines()))
+    chunk = sum(len(line) for _, lines in files for line in lines)
+    return files * (size // chunk + 1)
+
+
+def bench_translate(args):
+    """
+    Every copy of a file goes through its own FileTranslator, so the
+    translations it remembers are only those of that one file
+    """
+    files = generate_input(args.paths, int(args.size * 1e6))
+    line_count = command_count = 0
+    start = time.perf_counter()
+    for filename, lines in files:
+        state = VMTranslator.FileTranslator(filename, {})
+        for line in lines:
+            parsed_line = VMTranslator.remove_whitespace(line)
+            if parsed_line:
+                VMTranslator.translate(state, parsed_line)
+                command_count += 1
+        line_count += len(lines)
+    elapsed = time.perf_counter() - start
+    print('translate: %.1f MB, %d lines, %d commands in %.3fs, %d lines/s' % (
+        sum(len(line) for _, lines in files for line in lines) / 1e6,
+        line_count, command_count, elapsed, line_count / elapsed
+    ))
+
+
+BENCHMARKS = {
+    'compare': bench_compare,
+    'segments': bench_segments,
+    'tos': bench_tos,
+    'translate': bench_translate
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        'paths', nargs='+',
+        help='.vm files or directories, e.g. the project 7/8 test programs'
+    )
+    parser.add_argument(
+        '--size', type=float, default=8,
+        help='size of the generated translate input in megabytes'
+    )
+    parser.add_argument(
+        '--cycles', type=int, default=10 ** 8,
+        help='cycle budget for each program'
+    )
+    parser.add_argument(
+        '--stop', type=int,
+        help='RAM address a program sets to a non-zero value when done, '
+             'for programs that never reach a halt loop'
+    )
+    parser.add_argument(
+        '--shared-calls', action='store_true',
+        help='translate with shared call/return routines'
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,141 @@
+"""
+Peephole optimization of translated Hack assembly. The rules work on a
+list of instructions and labels with the comments already removed, and
+no pattern reaches across a label since a jump can enter there with
+other values in A and D.
+"""
+
+# PUSH_D immediately followed by POP_D, as in `push x / add`: SP ends
+# where it started and D is unchanged, the only effect besides A = SP is
+# the write into the free cell above the stack
+ROUND_TRIP = [
+    '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+    '@SP', 'A=M-1', 'D=M', '@SP', 'M=M-1'
+]
+
+# constants the ALU produces without going through D
+ALU_CONSTANTS = ('0', '1')
+
+
+def split_instruction(instruction):
+    """
+    dest, comp and jump of a C-instruction, '' for a missing field
+    """
+    dest = jump = ''
+    comp = instruction
+    if '=' in comp:
+        dest, comp = comp.split('=')
+    if ';' in comp:
+        comp, jump = comp.split(';')
+    return dest, comp, jump
+
+
+def d_is_dead(instructions, start):
+    """
+    Whether D is written before it is read from instructions[start] on,
+    a label, a jump or the end of the list count as reads
+    """
+    for index in range(start, len(instructions)):
+        instruction = instructions[index]
+        if instruction[0] == '(':
+            return False
+        if instruction[0] == '@':
+            continue
+        dest, comp, jump = split_instruction(instruction)
+        if 'D' in comp or jump:
+            return False
+        if 'D' in dest:
+            return True
+    return False
+
+
+def remove_round_trips(instructions):
+    result = []
+    index = 0
+    size = len(ROUND_TRIP)
+    while index < len(instructions):
+        if instructions[index] == '@SP' and (
+            instructions[index:index + size] == ROUND_TRIP
+        ):
+            result.append('@SP')
+            index += size
+        else:
+            result.append(instructions[index])
+            index += 1
+    return result
+
+
+def store_constants(instructions):
+    """
+    `@0 / D=A / @SP / A=M / M=D` becomes `@SP / A=M / M=0` when nothing
+    reads the constant from D afterwards
+    """
+    result = []
+    index = 0
+    while index < len(instructions):
+        constant = instructions[index][1:]
+        if (
+            constant in ALU_CONSTANTS and instructions[index][0] == '@' and
+            instructions[index + 1:index + 5] == ['D=A', '@SP', 'A=M', 'M=D']
+            and d_is_dead(instructions, index + 5)
+        ):
+            result.extend(['@SP', 'A=M', 'M=' + constant])
+            index += 5
+        else:
+            result.append(instructions[index])
+            index += 1
+    return result
+
+
+def remove_reloads(instructions):
+    """
+    Drop A-instructions loading the value A already holds and those
+    overwritten by the next instruction
+    """
+    result = []
+    loaded = None
+    last = len(instructions) - 1
+    for index, instruction in enumerate(instructions):
+        if instruction[0] == '(':
+            loaded = None
+        elif instruction[0] == '@':
+            if instruction == loaded:
+                continue
+            if index < last and instructions[index + 1][0] == '@':
+                continue
+            loaded = instruction
+        elif 'A' in split_instruction(instruction)[0]:
+            loaded = None
+        result.append(instruction)
+    return result
+
+
+def remove_dead_stores(instructions):
+    """
+    Drop `D=...` instructions whose value is overwritten before use
+    """
+    return [
+        instruction for index, instruction in enumerate(instructions)
+        if instruction[0] in '@(' or not instruction.startswith('D=') or
+        ';' in instruction or not d_is_dead(instructions, index + 1)
+    ]
+
+
+RULES = (remove_round_trips, store_constants, remove_reloads,
+         remove_dead_stores)
+
+
+def optimize(instructions):
+    """
+    Apply the rules until none of them shortens the list any further
+    """
+    while True:
+        size = len(instructions)
+        for rule in RULES:
+            instructions = rule(instructions)
+        if len(instructions) == size:
+            return instructions
+
+
+def count_instructions(instructions):
+    return sum(1 for instruction in instructions if instruction[0] != '(')
@@ -0,0 +1,36 @@
+"""
+Test programs and the course's .tst/.cmp files that go with them
+"""
+import os
+import re
+
+PROGRAMS_DIR = os.path.join(os.path.dirname(__file__), 'programs')
+PROGRAMS = sorted(os.listdir(PROGRAMS_DIR))
+
+
+def read_tst(path):
+    """
+    RAM values the test script sets and the number of cycles it runs
+    """
+    with open(path) as f:
+        script = f.read()
+    ram = {
+        int(address): int(value)
+        for address, value in re.findall(r'set RAM\[(\d+)\] (-?\d+)', script)
+    }
+    return ram, int(re.search(r'repeat (\d+)', script).group(1))
+
+
+def read_cmp(path):
+    """
+    address -> value for each pair of header and value lines
+    """
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    expected = {}
+    for header, values in zip(lines[::2], lines[1::2]):
+        expected.update(zip(
+            [int(address) for address in re.findall(r'RAM\[(\d+)', header)],
+            [int(value) for value in values.strip().strip('|').split('|')]
+        ))
+    return expected
@@ -0,0 +1,10 @@
+load DeadCode.asm,
+output-file DeadCode.out,
+compare-to DeadCode.cmp,
+output-list RAM[0]%D1.6.1 RAM[5]%D1.6.1;
+
+repeat 1000 {
+  ticktock;
+}
+
+output;
@@ -0,0 +1,10 @@
+load Idioms.asm,
+output-file Idioms.out,
+compare-to Idioms.cmp,
+output-list RAM[0]%D1.6.1 RAM[3001]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1 RAM[9]%D1.6.1 RAM[10]%D1.6.1 RAM[16]%D1.6.1 RAM[17]%D1.6.1;
+
+repeat 2000 {
+  ticktock;
+}
+
+output;
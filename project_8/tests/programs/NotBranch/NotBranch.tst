@@ -0,0 +1,12 @@
+load NotBranch.asm,
+output-file NotBranch.out,
+compare-to NotBranch.cmp,
+output-list RAM[0]%D1.6.1 RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1;
+
+set RAM[0] 256,
+
+repeat 300 {
+  ticktock;
+}
+
+output;
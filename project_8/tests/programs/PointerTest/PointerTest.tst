@@ -0,0 +1,16 @@
+load PointerTest.asm,
+output-file PointerTest.out,
+compare-to PointerTest.cmp,
+output-list RAM[256]%D1.6.1 RAM[3]%D1.6.1 RAM[4]%D1.6.1 RAM[3032]%D1.6.1 RAM[3046]%D1.6.1;
+
+set RAM[0] 256,
+set RAM[1] 300,
+set RAM[2] 400,
+set RAM[3] 3000,
+set RAM[4] 3010,
+
+repeat 450 {
+  ticktock;
+}
+
+output;
@@ -0,0 +1,10 @@
+load StaticsTest.asm,
+output-file StaticsTest.out,
+compare-to StaticsTest.cmp,
+output-list RAM[0]%D1.6.1 RAM[261]%D1.6.1 RAM[262]%D1.6.1;
+
+repeat 2500 {
+  ticktock;
+}
+
+output;
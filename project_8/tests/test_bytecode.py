@@ -0,0 +1,99 @@
+"""
+The .vmb format is written by the project 11 compiler and read by the
+project 7 and 8 translators, each with its own copy of the tables
+"""
+import contextlib
+import importlib.util
+import io
+import os
+
+import VMTranslator
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ROOT_DIR, path)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+JackCompiler = load_module('JackCompiler', 'project_11/JackCompiler.py')
+Project7Translator = load_module(
+    'Project7Translator', 'project_7/VMTranslator.py'
+)
+
+
+def test_tables_agree():
+    for module in (JackCompiler, Project7Translator):
+        assert module.BYTECODE_MAGIC == VMTranslator.BYTECODE_MAGIC
+        assert module.BYTECODE_RECORD.format == (
+            VMTranslator.BYTECODE_RECORD.format
+        )
+        assert module.BYTECODE_STRING_LENGTH.format == (
+            VMTranslator.BYTECODE_STRING_LENGTH.format
+        )
+    assert Project7Translator.BYTECODE_COMMANDS == (
+        VMTranslator.BYTECODE_COMMANDS
+    )
+    assert Project7Translator.BYTECODE_SEGMENTS == (
+        VMTranslator.BYTECODE_SEGMENTS
+    )
+    assert JackCompiler.BYTECODE_OPCODES == {
+        command: opcode
+        for opcode, command in enumerate(VMTranslator.BYTECODE_COMMANDS)
+    }
+    assert JackCompiler.BYTECODE_SEGMENTS == {
+        segment: code
+        for code, segment in enumerate(VMTranslator.BYTECODE_SEGMENTS)
+    }
+
+
+def big_class(count, name_length):
+    """
+    A class with count locals, a call with count arguments and a
+    function name name_length characters long
+    """
+    long_name = 'f' + 'x' * (name_length - 1)
+    parameters = ', '.join('int p%d' % i for i in range(count))
+    return '\n'.join([
+        'class Big {',
+        '    function int %s(%s) {' % (long_name, parameters),
+        '        var int %s;' % ', '.join('a%d' % i for i in range(count)),
+        '        let a%d = p0 + 1;' % (count - 1),
+        '        return a%d;' % (count - 1),
+        '    }',
+        '    function int g() {',
+        '        return Big.%s(%s);' % (
+            long_name, ', '.join(str(i) for i in range(count))
+        ),
+        '    }',
+        '}'
+    ]) + '\n'
+
+
+def compile_class(directory, source, bytecode):
+    directory.mkdir()
+    with open(str(directory / 'Big.jack'), 'w') as f:
+        f.write(source)
+    with contextlib.redirect_stdout(io.StringIO()):
+        JackCompiler.main(str(directory), use_cache=False, bytecode=bytecode)
+    return str(directory / ('Big.vmb' if bytecode else 'Big.vm'))
+
+
+def test_large_counts_and_long_names(tmp_path):
+    source = big_class(300, 300)
+    text = compile_class(tmp_path / 'text', source, False)
+    binary = compile_class(tmp_path / 'binary', source, True)
+    commands = VMTranslator.read_commands(text)
+    assert ('function', 'Big.f' + 'x' * 299, 300) in commands
+    assert VMTranslator.read_commands(binary) == commands
+    with open(binary, 'rb') as f:
+        assert Project7Translator.read_bytecode(f) == [
+            command if command[0] in ('push', 'pop') else
+            (command[0], None, None)
+            for command in commands
+        ]
@@ -0,0 +1,72 @@
+import peephole
+
+PUSH_D = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1']
+POP_D = ['@SP', 'A=M-1', 'D=M', '@SP', 'M=M-1']
+
+
+def test_d_is_dead():
+    assert peephole.d_is_dead(['@5', 'D=A'], 0)
+    assert not peephole.d_is_dead(['@5', 'M=D'], 0)
+    assert not peephole.d_is_dead(['(L)', 'D=A'], 0)
+    assert not peephole.d_is_dead(['0;JMP', 'D=A'], 0)
+    assert not peephole.d_is_dead(['@5'], 0)
+
+
+def test_remove_round_trips():
+    assert peephole.remove_round_trips(
+        PUSH_D + POP_D + ['@R13', 'M=D']
+    ) == ['@SP', '@R13', 'M=D']
+
+
+def test_store_constants():
+    assert peephole.store_constants(
+        ['@0', 'D=A', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1', '@5', 'D=M']
+    ) == ['@SP', 'A=M', 'M=0', '@SP', 'M=M+1', '@5', 'D=M']
+
+
+def test_store_constants_keeps_live_d():
+    instructions = ['@1', 'D=A', '@SP', 'A=M', 'M=D', '@5', 'M=D']
+    assert peephole.store_constants(instructions) == instructions
+
+
+def test_store_constants_only_alu_constants():
+    instructions = ['@7', 'D=A', '@SP', 'A=M', 'M=D', '@5', 'D=M']
+    assert peephole.store_constants(instructions) == instructions
+
+
+def test_remove_reloads():
+    assert peephole.remove_reloads(
+        ['@SP', 'M=M+1', '@SP', 'A=M-1', '@5', '@6', 'D=M']
+    ) == ['@SP', 'M=M+1', 'A=M-1', '@6', 'D=M']
+
+
+def test_remove_reloads_after_a_changes():
+    instructions = ['@SP', 'AM=M-1', '@SP', 'M=D', '(L)', '@SP', 'M=D']
+    assert peephole.remove_reloads(instructions) == instructions
+
+
+def test_remove_dead_stores():
+    assert peephole.remove_dead_stores(
+        ['D=M', '@5', 'D=A', 'M=D']
+    ) == ['@5', 'D=A', 'M=D']
+
+
+def test_remove_dead_stores_keeps_read_values():
+    for instructions in (['D=M', '@L', 'D;JGT'], ['D=M', '(L)', 'D=A'],
+                         ['D=M']):
+        assert peephole.remove_dead_stores(instructions) == instructions
+
+
+def test_optimize_reaches_fixpoint():
+    # push constant 0 / pop temp 0 / push constant 1 / pop temp 1
+    instructions = (
+        ['@0', 'D=A'] + PUSH_D + POP_D + ['@5', 'M=D'] +
+        ['@1', 'D=A'] + PUSH_D + POP_D + ['@6', 'M=D']
+    )
+    optimized = peephole.optimize(instructions)
+    assert optimized == ['@0', 'D=A', '@5', 'M=D', '@1', 'D=A', '@6', 'M=D']
+    assert peephole.optimize(optimized) == optimized
+
+
+def test_count_instructions():
+    assert peephole.count_instructions(['(L)', '@L', '0;JMP']) == 2
@@ -0,0 +1,39 @@
+"""
+Run the test programs on the VM interpreter and compare the final RAM
+against their .cmp files
+"""
+import os
+
+import pytest
+
+import VMInterpreter
+from course_files import PROGRAMS, PROGRAMS_DIR, read_cmp, read_tst
+
+
+def load(name):
+    program_dir = os.path.join(PROGRAMS_DIR, name)
+    if os.path.exists(os.path.join(program_dir, 'Sys.vm')):
+        return VMInterpreter.VMProgram(program_dir)
+    return VMInterpreter.VMProgram(os.path.join(program_dir, name + '.vm'))
+
+
+@pytest.mark.parametrize('name', PROGRAMS)
+def test_program(name):
+    ram, steps = read_tst(os.path.join(PROGRAMS_DIR, name, name + '.tst'))
+    expected = read_cmp(os.path.join(PROGRAMS_DIR, name, name + '.cmp'))
+    interpreter = VMInterpreter.VMInterpreter(load(name), ram)
+    interpreter.run(steps)
+    assert {
+        address: interpreter.ram[address] for address in expected
+    } == expected
+
+
+def test_return_outside_program_halts():
+    # SimpleFunction returns to the address 1000 its test script sets
+    ram, steps = read_tst(os.path.join(
+        PROGRAMS_DIR, 'SimpleFunction', 'SimpleFunction.tst'
+    ))
+    interpreter = VMInterpreter.VMInterpreter(load('SimpleFunction'), ram)
+    assert interpreter.run(steps) == 10
+    assert interpreter.halted
+    assert interpreter.run(steps) == 0
@@ -0,0 +1,157 @@
+"""
+Translate the test programs in every mode, run them on the project 6
+emulator and compare the final RAM against their .cmp files
+"""
+import contextlib
+import io
+import os
+import shutil
+
+import pytest
+
+import VMTranslator
+import assembler
+import emulator
+from course_files import PROGRAMS, PROGRAMS_DIR, read_cmp, read_tst
+
+MODES = {
+    'default': {},
+    'peephole': {'optimize': True},
+    'cache-tos': {'cache_tos': True},
+    'fuse': {'fuse': True},
+    'specialize-segments': {'specialize_segments': True},
+    'compact-locals': {'compact_locals': True},
+    'remove-dead': {'remove_dead': True},
+    'shared-calls': {'shared_calls': True},
+    'shared-compare': {'shared_compare': True},
+    'jobs': {'jobs': 2},
+    'all': {
+        'shared_calls': True,
+        'shared_compare': True,
+        'optimize': True,
+        'cache_tos': True,
+        'fuse': True,
+        'specialize_segments': True,
+        'compact_locals': True,
+        'remove_dead': True
+    }
+}
+
+
+def translate(tmp_path, name, **options):
+    """
+    Translate a copy of the program, its directory when it has a Sys.vm
+    and its single file otherwise, returning the generated assembly
+    """
+    program_dir = str(tmp_path / name)
+    shutil.copytree(os.path.join(PROGRAMS_DIR, name), program_dir)
+    path = program_dir
+    if not os.path.exists(os.path.join(program_dir, 'Sys.vm')):
+        path = os.path.join(program_dir, name + '.vm')
+    with contextlib.redirect_stdout(io.StringIO()):
+        VMTranslator.main(path, **options)
+    with open(VMTranslator.get_output_path(path)) as f:
+        return f.read()
+
+
+def run(asm, ram, cycles):
+    cpu = emulator.HackEmulator(assembler.assemble(asm.split('\n')))
+    for address, value in ram.items():
+        cpu.ram[address] = value
+    cpu.run(cycles)
+    return cpu.ram
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+@pytest.mark.parametrize('name', PROGRAMS)
+def test_program(tmp_path, name, mode):
+    asm = translate(tmp_path, name, **MODES[mode])
+    ram, cycles = read_tst(os.path.join(PROGRAMS_DIR, name, name + '.tst'))
+    expected = read_cmp(os.path.join(PROGRAMS_DIR, name, name + '.cmp'))
+    ram = run(asm, ram, cycles)
+    assert {address: ram[address] for address in expected} == expected
+
+
+def test_fuse_not_branch(tmp_path):
+    assert '// not / if-goto' in translate(tmp_path, 'NotBranch', fuse=True)
+
+
+def test_fuse_idioms(tmp_path):
+    asm = translate(tmp_path, 'Idioms', fuse=True)
+    for comment in (
+        '// pop pointer 1 / push that 0',
+        '// pop temp 0 / pop pointer 1 / push temp 0 / pop that 0',
+        '// push local 1 / push constant 3 / add / pop local 1',
+        '// push constant 1 / add',
+        '// lt / not',
+        '// push constant 0 / not',
+        '// not / not',
+        '// gt / not / if-goto SKIP',
+        '// eq / if-goto DONE'
+    ):
+        assert comment in asm
+
+
+def test_fuse_never_grows_output(tmp_path):
+    # the inline negated compare is longer than a shared compare call
+    asm = translate(tmp_path, 'Idioms', fuse=True, shared_compare=True)
+    assert '// lt / not' not in asm
+    state = VMTranslator.FileTranslator('Idioms.vm', {
+        'fuse': True,
+        'shared_compare': True
+    })
+    commands = VMTranslator.read_commands(
+        os.path.join(PROGRAMS_DIR, 'Idioms', 'Sys.vm')
+    )
+    list(VMTranslator.translate_fused(state, commands))
+    assert state.idiom_counts
+    assert all(saved >= 0 for _, saved in state.idiom_counts.values())
+
+
+@pytest.mark.parametrize('remove_dead', [False, True])
+def test_remove_dead(tmp_path, remove_dead):
+    asm = translate(tmp_path, 'DeadCode', remove_dead=remove_dead)
+    assert '(Main.double)' in asm
+    assert ('(Main.unused)' in asm) != remove_dead
+
+
+def test_jobs_match_serial(tmp_path):
+    options = {'cache_tos': True, 'fuse': True, 'shared_compare': True}
+    serial = translate(tmp_path / 'serial', 'StaticsTest', **options)
+    parallel = translate(tmp_path / 'parallel', 'StaticsTest', jobs=2,
+                         **options)
+    assert parallel == serial
+
+
+def test_compact_locals_picks_smaller_prologue():
+    # stores take 2 * count + 4 instructions, the loop 9 for any count
+    unrolled = VMTranslator.compact_prologue('f', 2)
+    loop = VMTranslator.compact_prologue('f', 3)
+    assert '(f$$locals)' not in unrolled
+    assert VMTranslator.count_instructions(unrolled) == 8
+    assert '(f$$locals)' in loop
+    assert VMTranslator.count_instructions(loop) == 9
+
+
+def test_memo_is_per_file_and_bounded():
+    state = VMTranslator.FileTranslator('Memo.vm', {})
+    for i in range(VMTranslator.MEMO_SIZE + 10):
+        VMTranslator.translate(state, 'push constant %d' % i)
+    VMTranslator.translate(state, 'push static 0')
+    assert len(state.memo) == VMTranslator.MEMO_SIZE
+    assert not VMTranslator.FileTranslator('Other.vm', {}).memo
+
+
+def test_lines_and_tuples_translate_alike():
+    for options in ({}, {'cache_tos': True}):
+        for line in ('push constant 7', 'pop local 2', 'add', 'call f 1'):
+            by_line = VMTranslator.FileTranslator('A.vm', options)
+            by_tuple = VMTranslator.FileTranslator('A.vm', options)
+            words = line.split()
+            assert VMTranslator.translate(by_line, line) == (
+                VMTranslator.translate_command(by_tuple, *words)
+            )
+    with pytest.raises(NotImplementedError):
+        VMTranslator.translate(
+            VMTranslator.FileTranslator('A.vm', {}), 'push constant'
+        )